@@ -1,35 +1,38 @@
 import argparse
 import json
+import multiprocessing
+import os
 import os.path
+import shutil
 import uuid
 
 def add_arguments(parser):
-    parser.add_argument("--data_format", help="data format", required=True)
+    parser.add_argument("--data_format", help="data format, json, jsonl or text", required=True)
     parser.add_argument("--input_file", help="input data file", required=True)
     parser.add_argument("--output_file", help="output data file", required=True)
+    parser.add_argument("--num_workers", help="number of worker processes, each converting a slice of the input file", type=int, default=1)
+    parser.add_argument("--id_format", help="sentence id format, uuid or sequential", default="uuid")
 
-def preprocess(input_file,
-               output_file,
-               data_format):
-    if not os.path.exists(input_file):
-        raise FileNotFoundError("file not found")
-    
-    processed_data_list = []
-    with open(input_file, "r") as file:
+def iter_sentences(input_file,
+                   start_offset=0,
+                   end_offset=None):
+    """Yields the tokens and labels of every sentence in the byte range [start_offset, end_offset) of the input file."""
+    with open(input_file, "rb") as file:
+        file.seek(start_offset)
         token_list = []
         label_list = []
-        for line in file:
-            items = [item for item in line.strip().split(' ') if item]
+        while end_offset is None or file.tell() < end_offset:
+            line = file.readline()
+            if not line:
+                break
+            
+            items = [item for item in line.decode("utf-8").strip().split(' ') if item]
             if len(items) == 0:
                 if len(token_list) > 0 and len(label_list) > 0 and len(token_list) == len(label_list):
-                    processed_data_list.append({
-                        "id": str(uuid.uuid4()),
-                        "text": " ".join(token_list),
-                        "label": " ".join(label_list)
-                    })
+                    yield token_list, label_list
                 
-                token_list.clear()
-                label_list.clear()
+                token_list = []
+                label_list = []
                 continue
             
             if len(items) < 4:
@@ -43,27 +46,152 @@ def preprocess(input_file,
             
             token_list.append(token)
             label_list.append(label)
+        
+        if len(token_list) > 0 and len(label_list) > 0 and len(token_list) == len(label_list):
+            yield token_list, label_list
+
+def get_chunk_offsets(input_file,
+                      num_chunks):
+    """Splits the input file into byte ranges that start and end on sentence boundaries, i.e. right after blank lines."""
+    file_size = os.path.getsize(input_file)
+    offsets = [0]
+    with open(input_file, "rb") as file:
+        for chunk_index in range(1, num_chunks):
+            offset = max(file_size * chunk_index // num_chunks, offsets[-1])
+            file.seek(offset)
+            
+            # Skip the rest of the line the offset falls into, then everything up to the next blank line.
+            file.readline()
+            line = file.readline()
+            while line and line.strip():
+                line = file.readline()
+            
+            offsets.append(file.tell())
     
+    offsets.append(file_size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def format_record(data,
+                  data_format):
     if data_format == "json":
-        save_json(processed_data_list, output_file)
+        # Matches the layout of json.dumps(data_list, indent=4) without building the whole list.
+        return "    " + json.dumps(data, indent=4).replace("\n", "\n    ")
+    elif data_format == "jsonl":
+        return json.dumps(data) + "\n"
     elif data_format == "text":
-        save_text(processed_data_list, output_file)
+        return "{0}\t{1}\t{2}\r\n".format(data["id"], data["text"], data["label"])
+    else:
+        raise ValueError("unsupported data format {0}".format(data_format))
+
+def write_records(file,
+                  sentences,
+                  data_format,
+                  id_format,
+                  start_id=0):
+    """Writes sentences to an open binary file as they are read, returns the number of sentences written."""
+    separator = ",\n" if data_format == "json" else ""
+    num_records = 0
+    for token_list, label_list in sentences:
+        data = {
+            "id": str(uuid.uuid4()) if id_format == "uuid" else str(start_id + num_records),
+            "text": " ".join(token_list),
+            "label": " ".join(label_list)
+        }
+        
+        record = format_record(data, data_format)
+        if num_records > 0:
+            record = separator + record
+        
+        file.write(record.encode("utf-8"))
+        num_records += 1
+    
+    return num_records
+
+def count_chunk(chunk):
+    (input_file, start_offset, end_offset) = chunk
+    return sum(1 for _ in iter_sentences(input_file, start_offset, end_offset))
+
+def preprocess_chunk(chunk):
+    (input_file, part_file, data_format, id_format, start_offset, end_offset, start_id) = chunk
+    with open(part_file, "wb") as file:
+        return write_records(file, iter_sentences(input_file, start_offset, end_offset), data_format, id_format, start_id)
 
-def save_json(data_list,
-              data_path):
-    with open(data_path, "w") as file:
-        data_json = json.dumps(data_list, indent=4)
-        file.write(data_json)
+def preprocess(input_file,
+               output_file,
+               data_format,
+               num_workers=1,
+               id_format="uuid"):
+    if not os.path.exists(input_file):
+        raise FileNotFoundError("file not found")
+    
+    if id_format not in ["uuid", "sequential"]:
+        raise ValueError("unsupported id format {0}".format(id_format))
+    
+    # Sentences are written as soon as they are read, so memory use does not grow with the input file.
+    if num_workers <= 1:
+        with open(output_file, "wb") as file:
+            if data_format == "json":
+                file.write(b"[\n")
+            
+            num_examples = write_records(file, iter_sentences(input_file), data_format, id_format)
+            
+            if data_format == "json":
+                file.write(b"\n]")
+    else:
+        chunk_offsets = get_chunk_offsets(input_file, num_workers)
+        pool = multiprocessing.Pool(processes=num_workers)
+        try:
+            # Sequential ids must continue across chunks, so count the sentences of each chunk first.
+            start_ids = [0] * len(chunk_offsets)
+            if id_format == "sequential":
+                chunk_counts = pool.map(count_chunk, [(input_file, start_offset, end_offset) for start_offset, end_offset in chunk_offsets])
+                for chunk_index in range(1, len(chunk_offsets)):
+                    start_ids[chunk_index] = start_ids[chunk_index - 1] + chunk_counts[chunk_index - 1]
+            
+            part_files = ["{0}.part-{1:05d}".format(output_file, chunk_index) for chunk_index in range(len(chunk_offsets))]
+            chunks = [(input_file, part_file, data_format, id_format, start_offset, end_offset, start_id)
+                for part_file, (start_offset, end_offset), start_id in zip(part_files, chunk_offsets, start_ids)]
+            part_counts = pool.map(preprocess_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        
+        num_examples = merge_parts(part_files, part_counts, output_file, data_format)
+    
+    # Lets the training scripts size the train set without reading the data file.
+    with open("{0}.manifest".format(output_file), "w") as file:
+        json.dump({ "num_examples": num_examples }, file)
+    
+    print("Wrote {0} sentences to {1}".format(num_examples, output_file))
 
-def save_text(data_list,
-              data_path):
-    with open(data_path, "wb") as file:
-        for data in data_list:
-            data_text = "{0}\t{1}\t{2}\r\n".format(data["id"], data["text"], data["label"])
-            file.write(data_text.encode("utf-8"))
+def merge_parts(part_files,
+                part_counts,
+                output_file,
+                data_format):
+    """Concatenates the part files written by the workers in input order and removes them."""
+    num_examples = 0
+    with open(output_file, "wb") as file:
+        if data_format == "json":
+            file.write(b"[\n")
+        
+        for part_file, part_count in zip(part_files, part_counts):
+            if part_count > 0:
+                if data_format == "json" and num_examples > 0:
+                    file.write(b",\n")
+                
+                with open(part_file, "rb") as part:
+                    shutil.copyfileobj(part, file)
+            
+            num_examples += part_count
+            os.remove(part_file)
+        
+        if data_format == "json":
+            file.write(b"\n]")
+    
+    return num_examples
 
 def main(args):
-    preprocess(args.input_file, args.output_file, args.data_format)
+    preprocess(args.input_file, args.output_file, args.data_format, args.num_workers, args.id_format)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
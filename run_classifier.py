@@ -3,20 +3,31 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import contextlib
+import copy
 import csv
+import hashlib
 import json
+import multiprocessing
 import os
+import resource
 import time
 
 import numpy as np
 import tensorflow as tf
 
+from tensorflow.python.client import timeline
+from tensorflow.python.ops import collective_ops
+
 from bert import modeling
 from bert import optimization
 from bert import tokenization
 
 MIN_FLOAT = -1e30
 
+# Per-batch stats of training, read by `TrainingStatsHook`.
+TRAINING_STATS = ["num_examples", "num_real_tokens", "num_tokens", "input_ready_time"]
+
 flags = tf.flags
 FLAGS = flags.FLAGS
 
@@ -41,19 +52,47 @@ flags.DEFINE_integer(
 flags.DEFINE_bool("do_train", False, "Whether to run training.")
 flags.DEFINE_bool("do_eval", False, "Whether to run evaluation.")
 flags.DEFINE_bool("do_predict", False, "Whether to run prediction.")
+flags.DEFINE_bool("do_train_and_eval", False, "Whether to evaluate on the dev set at every checkpoint (every `save_checkpoints_steps` steps) during training, exporting the best checkpoint to `export_dir`.")
+flags.DEFINE_string("eval_metric", "sent_accuracy", "Dev metric that decides the best checkpoint and early stopping during train-and-evaluate, i.e. `sent_accuracy`.")
+flags.DEFINE_integer("early_stopping_patience", 0, "Number of evaluations without improvement of `eval_metric` after which train-and-evaluate stops, 0 never stops early.")
 flags.DEFINE_bool("do_export", False, "Whether to run exporting.")
 
 flags.DEFINE_integer("train_batch_size", 32, "Total batch size for training.")
+flags.DEFINE_string("encoder_output_dir", None, "[Optional] Directory to store the outputs of the frozen BERT encoder in. When set, the encoder runs once over each data set and only the task heads are trained, from the stored outputs.")
+flags.DEFINE_bool("encoder_output_float16", True, "Whether to store encoder outputs as float16, halving their size on disk.")
+flags.DEFINE_bool("freeze_embeddings", False, "Whether to keep the BERT embeddings fixed during fine-tuning.")
+flags.DEFINE_integer("freeze_layers", 0, "Number of bottom BERT encoder layers to keep fixed during fine-tuning.")
+flags.DEFINE_bool("use_collective_all_reduce", False, "Whether to train data-parallel across the workers listed in TF_CONFIG, averaging gradients with collective all-reduce. `train_batch_size` is split across the workers.")
+flags.DEFINE_integer("gradient_accumulation_steps", 1, "Number of micro-batches of `train_batch_size / gradient_accumulation_steps` examples whose gradients are accumulated into one optimizer step.")
 flags.DEFINE_integer("eval_batch_size", 8, "Total batch size for eval.")
 flags.DEFINE_integer("predict_batch_size", 8, "Total batch size for predict.")
 
+flags.DEFINE_string("data_format", "json", "Format of the data files, either 'json' (a single json list) or 'jsonl' (one json object per line).")
+flags.DEFINE_bool("stream_train_data", False, "Whether to stream train examples from the data file instead of converting them all up front. Requires 'jsonl' data.")
+flags.DEFINE_integer("num_preprocess_workers", 1, "Number of worker processes used to convert examples into features.")
+flags.DEFINE_bool("use_tfrecord", True, "Whether to feed the estimator from sharded TFRecord files instead of in-graph constants.")
+flags.DEFINE_integer("num_tfrecord_shards", 8, "Number of TFRecord shards to write for each data set.")
+flags.DEFINE_integer("num_parallel_calls", -1, "Number of records the input pipeline decodes or gathers in parallel. -1 lets tf.data autotune it.")
+flags.DEFINE_integer("prefetch_buffer_size", -1, "Number of batches the input pipeline prepares ahead of the model. -1 lets tf.data autotune it, 0 disables prefetching.")
+flags.DEFINE_integer("shuffle_buffer_size", 0, "Number of train examples shuffled together. 0 shuffles the whole train set (10000 examples when streaming).")
+flags.DEFINE_string("eval_cache_dir", None, "[Optional] Directory to cache decoded eval and predict records in, so repeated evaluations skip reading and parsing the TFRecord shards.")
+flags.DEFINE_string("memmap_feature_dir", None, "[Optional] Directory of memory-mapped feature matrices, e.g. built by tool/build_memmap.py. Data sets are read from it in place and converted into it when missing.")
+flags.DEFINE_bool("do_bucketing", False, "Whether to batch examples of similar length together and pad each batch only as far as it needs, instead of to `max_seq_length`.")
+flags.DEFINE_string("bucket_boundaries", None, "[Optional] Comma-separated lengths to pad bucketed batches up to, e.g. '16,32,64'. If not set, each batch is padded to its longest example.")
+flags.DEFINE_bool("do_packing", False, "Whether to pack several short train examples into each `max_seq_length` row.")
+flags.DEFINE_integer("max_examples_per_pack", 8, "Maximum number of examples packed into one row. Only used if `do_packing` is True.")
+flags.DEFINE_string("feature_cache_dir", None, "[Optional] Directory to cache converted features in. Entries are keyed by the content of the data, vocab and label files.")
+
 flags.DEFINE_float("learning_rate", 5e-5, "The initial learning rate for Adam.")
 flags.DEFINE_float("num_train_epochs", 3.0, "Total number of training epochs to perform.")
 flags.DEFINE_float("warmup_proportion", 0.1, "Proportion of training to perform linear learning rate warmup for.")
 
+flags.DEFINE_integer("train_stats_steps", 100, "How often to log training throughput, padding and input-pipeline wait stats and write them as summaries, 0 to disable. The stats of the whole run go to train_stats.json in the model dir. Not supported on TPU.")
+flags.DEFINE_string("profile_steps", None, "[Optional] Step window `<start>:<end>` of training and prediction to capture a full trace of, e.g. '100:110', counting from the first step of each. The timelines go to `profile/train` and `profile/predict` in the model dir, summarize them with tool/profile_summary.py.")
 flags.DEFINE_integer("save_checkpoints_steps", 1000, "How often to save the model checkpoint.")
 flags.DEFINE_integer("iterations_per_loop", 1000, "How many steps to make in each estimator call.")
 
+flags.DEFINE_bool("use_xla", False, "Whether to compile the model with XLA, auto-clustering the training, evaluation and prediction graphs and marking the model ops of the exported SavedModel for compilation wherever it is served. Not used on TPU, which always compiles with XLA.")
 flags.DEFINE_bool("use_tpu", False, "Whether to use TPU or GPU/CPU.")
 flags.DEFINE_integer("num_tpu_cores", 8,"Only used if `use_tpu` is True. Total number of TPU cores to use.")
 flags.DEFINE_string("master", None, "[Optional] TensorFlow master URL.")
@@ -116,35 +155,203 @@ class InputFeatures(object):
         self.segment_ids = segment_ids
         self.sent_label_id = sent_label_id
 
+class InputFeatureColumns(object):
+    """The features of a whole data set, stored column-wise as one preallocated int32 array per field."""
+    def __init__(self,
+                 input_ids,
+                 input_masks,
+                 segment_ids,
+                 sent_label_ids):
+        self.input_ids = input_ids
+        self.input_masks = input_masks
+        self.segment_ids = segment_ids
+        self.sent_label_ids = sent_label_ids
+    
+    @classmethod
+    def allocate(cls,
+                 num_features,
+                 max_seq_length):
+        """Allocates zero-filled columns for `num_features` features."""
+        return cls(
+            input_ids=np.zeros([num_features, max_seq_length], dtype=np.int32),
+            input_masks=np.zeros([num_features, max_seq_length], dtype=np.int32),
+            segment_ids=np.zeros([num_features, max_seq_length], dtype=np.int32),
+            sent_label_ids=np.zeros([num_features], dtype=np.int32))
+    
+    @classmethod
+    def open_memmap(cls,
+                    feature_dir,
+                    num_features,
+                    max_seq_length):
+        """Creates zero-filled columns backed by one `.npy` file per field in `feature_dir`, to be filled in place."""
+        tf.gfile.MakeDirs(feature_dir)
+        return cls(
+            input_ids=np.lib.format.open_memmap(os.path.join(feature_dir, "input_ids.npy"), mode="w+", dtype=np.int32, shape=(num_features, max_seq_length)),
+            input_masks=np.lib.format.open_memmap(os.path.join(feature_dir, "input_masks.npy"), mode="w+", dtype=np.int32, shape=(num_features, max_seq_length)),
+            segment_ids=np.lib.format.open_memmap(os.path.join(feature_dir, "segment_ids.npy"), mode="w+", dtype=np.int32, shape=(num_features, max_seq_length)),
+            sent_label_ids=np.lib.format.open_memmap(os.path.join(feature_dir, "sent_label_ids.npy"), mode="w+", dtype=np.int32, shape=(num_features,)))
+    
+    @classmethod
+    def load_memmap(cls,
+                    feature_dir):
+        """Memory-maps the `.npy` files in `feature_dir` read-only, so rows are only read from disk when accessed."""
+        return cls(
+            input_ids=np.load(os.path.join(feature_dir, "input_ids.npy"), mmap_mode="r"),
+            input_masks=np.load(os.path.join(feature_dir, "input_masks.npy"), mmap_mode="r"),
+            segment_ids=np.load(os.path.join(feature_dir, "segment_ids.npy"), mmap_mode="r"),
+            sent_label_ids=np.load(os.path.join(feature_dir, "sent_label_ids.npy"), mmap_mode="r"))
+    
+    def flush(self):
+        """Flushes memory-mapped columns to disk."""
+        for column in [self.input_ids, self.input_masks, self.segment_ids, self.sent_label_ids]:
+            if isinstance(column, np.memmap):
+                column.flush()
+    
+    def __len__(self):
+        return self.input_ids.shape[0]
+    
+    def __getitem__(self,
+                    index):
+        """Gets a single feature as `InputFeatures`, e.g. for decoding predictions."""
+        return InputFeatures(
+            input_ids=self.input_ids[index].tolist(),
+            input_masks=self.input_masks[index].tolist(),
+            segment_ids=self.segment_ids[index].tolist(),
+            sent_label_id=int(self.sent_label_ids[index]))
+    
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+    
+    def set_feature(self,
+                    index,
+                    feature):
+        """Writes a single `InputFeatures` into row `index`."""
+        self.input_ids[index] = feature.input_ids
+        self.input_masks[index] = feature.input_masks
+        self.segment_ids[index] = feature.segment_ids
+        self.sent_label_ids[index] = feature.sent_label_id
+    
+    def set_features(self,
+                     start_index,
+                     features):
+        """Copies another `InputFeatureColumns` into the rows starting at `start_index`."""
+        end_index = start_index + len(features)
+        self.input_ids[start_index:end_index] = features.input_ids
+        self.input_masks[start_index:end_index] = features.input_masks
+        self.segment_ids[start_index:end_index] = features.segment_ids
+        self.sent_label_ids[start_index:end_index] = features.sent_label_ids
+    
+    def shard(self,
+              num_shards,
+              shard_index):
+        """Gets every `num_shards`-th feature starting at `shard_index`, as views of the same columns."""
+        return InputFeatureColumns(**dict([(name, column[shard_index::num_shards]) for (name, column) in vars(self).items()]))
+
+class PackedInputFeatures(object):
+    """The packed rows of a data set, stored column-wise as one preallocated int32 array per field.
+    
+    Every row packs several examples together, each with its own [CLS] position.
+    """
+    def __init__(self,
+                 input_ids,
+                 input_masks,
+                 segment_ids,
+                 position_ids,
+                 pack_ids,
+                 cls_positions,
+                 sent_label_ids,
+                 sent_masks):
+        self.input_ids = input_ids
+        self.input_masks = input_masks
+        self.segment_ids = segment_ids
+        self.position_ids = position_ids
+        self.pack_ids = pack_ids
+        self.cls_positions = cls_positions
+        self.sent_label_ids = sent_label_ids
+        self.sent_masks = sent_masks
+    
+    @classmethod
+    def allocate(cls,
+                 num_rows,
+                 max_seq_length,
+                 max_examples_per_pack):
+        """Allocates zero-filled columns for `num_rows` packed rows."""
+        return cls(
+            input_ids=np.zeros([num_rows, max_seq_length], dtype=np.int32),
+            input_masks=np.zeros([num_rows, max_seq_length], dtype=np.int32),
+            segment_ids=np.zeros([num_rows, max_seq_length], dtype=np.int32),
+            position_ids=np.zeros([num_rows, max_seq_length], dtype=np.int32),
+            pack_ids=np.zeros([num_rows, max_seq_length], dtype=np.int32),
+            cls_positions=np.zeros([num_rows, max_examples_per_pack], dtype=np.int32),
+            sent_label_ids=np.zeros([num_rows, max_examples_per_pack], dtype=np.int32),
+            sent_masks=np.zeros([num_rows, max_examples_per_pack], dtype=np.int32))
+    
+    def __len__(self):
+        return self.input_ids.shape[0]
+
 class ClassificationProcessor(object):
     """Processor for the classification data set."""
     def __init__(self,
                  data_dir,
-                 task_name):
+                 task_name,
+                 data_format="json"):
         self.data_dir = data_dir
         self.task_name = task_name
+        self.data_format = data_format
     
     def get_train_examples(self):
         """Gets a collection of `InputExample`s for the train set."""
-        data_path = os.path.join(self.data_dir, "train-{0}".format(self.task_name), "train-{0}.json".format(self.task_name))
-        data_list = self._read_json(data_path)
+        data_path = self.get_data_path("train")
+        data_list = self._read_data(data_path)
         example_list = self._get_example(data_list)
         return example_list
     
     def get_dev_examples(self):
         """Gets a collection of `InputExample`s for the dev set."""
-        data_path = os.path.join(self.data_dir, "dev-{0}".format(self.task_name), "dev-{0}.json".format(self.task_name))
-        data_list = self._read_json(data_path)
+        data_path = self.get_data_path("dev")
+        data_list = self._read_data(data_path)
         example_list = self._get_example(data_list)
         return example_list
     
     def get_test_examples(self):
         """Gets a collection of `InputExample`s for the test set."""
-        data_path = os.path.join(self.data_dir, "test-{0}".format(self.task_name), "test-{0}.json".format(self.task_name))
-        data_list = self._read_json(data_path)
+        data_path = self.get_data_path("test")
+        data_list = self._read_data(data_path)
         example_list = self._get_example(data_list)
         return example_list
     
+    def iter_train_examples(self):
+        """Lazily yields the `InputExample`s of the train set, one line at a time for JSON Lines data."""
+        data_path = self.get_data_path("train")
+        data_list = self._read_data(data_path)
+        return self._iter_example(data_list)
+    
+    def get_num_examples(self,
+                         data_type):
+        """Gets the number of examples in the train, dev or test set without building them."""
+        data_path = self.get_data_path(data_type)
+        manifest_path = "{0}.manifest".format(data_path)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                return json.load(file)["num_examples"]
+        
+        if self.data_format == "jsonl":
+            with open(data_path, "rb") as file:
+                return sum(1 for line in file if line.strip())
+        
+        return len(self._read_json(data_path))
+    
+    def get_data_path(self,
+                      data_type):
+        """Gets the path of the json (or jsonl) file for the train, dev or test set."""
+        data_name = "{0}-{1}".format(data_type, self.task_name)
+        return os.path.join(self.data_dir, data_name, "{0}.{1}".format(data_name, self.data_format))
+    
+    def get_label_paths(self):
+        """Gets the paths of the label vocab files for this data set."""
+        return [os.path.join(self.data_dir, "resource", "sent_label.vocab")]
+    
     def get_sent_labels(self):
         """Gets the list of sentence labels for this data set."""
         data_path = os.path.join(self.data_dir, "resource", "sent_label.vocab")
@@ -172,17 +379,36 @@ class ClassificationProcessor(object):
         else:
             raise FileNotFoundError("data path not found")
     
+    def _read_jsonl(self,
+                    data_path):
+        if os.path.exists(data_path):
+            with open(data_path, "r") as file:
+                for line in file:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            raise FileNotFoundError("data path not found")
+    
+    def _read_data(self,
+                   data_path):
+        if self.data_format == "jsonl":
+            return self._read_jsonl(data_path)
+        else:
+            return self._read_json(data_path)
+    
     def _get_example(self,
                      data_list):
-        example_list = []
+        example_list = list(self._iter_example(data_list))
+        return example_list
+    
+    def _iter_example(self,
+                      data_list):
         for data in data_list:
             guid = data["id"]
             text = tokenization.convert_to_unicode(data["text"])
             sent_label = tokenization.convert_to_unicode(data["sent_label"])
             example = InputExample(guid=guid, text=text, sent_label=sent_label)
-            example_list.append(example)
-        
-        return example_list
+            yield example
 
 def convert_single_example(ex_index,
                            example,
@@ -270,56 +496,738 @@ def convert_single_example(ex_index,
         sent_label_id=sent_label_id)
     return feature
 
+_worker_tokenizer = None
+
+def _init_convert_worker(tokenizer):
+    """Gives each conversion worker process its own copy of the tokenizer."""
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _convert_example_shard(shard):
+    """Converts a contiguous shard of `InputExample`s inside a worker process."""
+    (start_index, examples, sent_label_list, max_seq_length) = shard
+    features = InputFeatureColumns.allocate(len(examples), max_seq_length)
+    for (offset, example) in enumerate(examples):
+        feature = convert_single_example(start_index + offset, example, sent_label_list, max_seq_length, _worker_tokenizer)
+        features.set_feature(offset, feature)
+    
+    return features
+
 def convert_examples_to_features(examples,
                                  sent_label_list,
                                  max_seq_length,
-                                 tokenizer):
-    """Convert a set of `InputExample`s to a list of `InputFeatures`."""
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
+                                 tokenizer,
+                                 num_workers=1,
+                                 shard_size=10000,
+                                 features=None):
+    """Convert a set of `InputExample`s to `InputFeatureColumns`, writing each feature straight into its row.
+    
+    The columns are allocated in memory unless preallocated ones (e.g. memory-mapped) are passed as `features`.
+    """
+    if features is None:
+        features = InputFeatureColumns.allocate(len(examples), max_seq_length)
+    
+    if num_workers <= 1:
+        for (ex_index, example) in enumerate(examples):
+            if ex_index % shard_size == 0:
+                tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
+            
+            feature = convert_single_example(ex_index, example, sent_label_list, max_seq_length, tokenizer)
+            features.set_feature(ex_index, feature)
+        
+        return features
+    
+    # Shards are contiguous and `imap` yields them in submission order, so the
+    # features come back in the same order as the input examples.
+    shards = [(start_index, examples[start_index:start_index + shard_size], sent_label_list, max_seq_length)
+        for start_index in range(0, len(examples), shard_size)]
+    
+    pool = multiprocessing.Pool(processes=num_workers, initializer=_init_convert_worker, initargs=(tokenizer,))
+    try:
+        for (shard_index, shard_features) in enumerate(pool.imap(_convert_example_shard, shards)):
+            tf.logging.info("Writing example %d of %d" % (shard_index * shard_size, len(examples)))
+            features.set_features(shard_index * shard_size, shard_features)
+    finally:
+        pool.close()
+        pool.join()
+    
+    return features
+
+def pack_features(features,
+                  max_seq_length,
+                  max_examples_per_pack):
+    """Packs short features into as few `max_seq_length` rows as possible, best fit in decreasing length order."""
+    lengths = features.input_masks.sum(axis=1).tolist()
+    order = sorted(range(len(features)), key=lambda index: -lengths[index])
+    
+    packs = []
+    open_packs = collections.defaultdict(list)
+    for index in order:
+        length = lengths[index]
+        pack_index = None
+        for space in range(length, max_seq_length + 1):
+            if open_packs[space]:
+                pack_index = open_packs[space].pop()
+                break
+        
+        if pack_index is None:
+            pack_index = len(packs)
+            packs.append([])
+            space = max_seq_length
+        
+        packs[pack_index].append(index)
+        space -= length
+        if space > 0 and len(packs[pack_index]) < max_examples_per_pack:
+            open_packs[space].append(pack_index)
+    
+    # Rows come out roughly sorted by length, so shuffle them before they reach the input pipeline.
+    np.random.shuffle(packs)
+    
+    packed_features = PackedInputFeatures.allocate(len(packs), max_seq_length, max_examples_per_pack)
+    for (row_index, pack) in enumerate(packs):
+        start_index = 0
+        for (pack_id, index) in enumerate(pack, start=1):
+            length = lengths[index]
+            end_index = start_index + length
+            packed_features.input_ids[row_index, start_index:end_index] = features.input_ids[index, :length]
+            packed_features.input_masks[row_index, start_index:end_index] = features.input_masks[index, :length]
+            packed_features.segment_ids[row_index, start_index:end_index] = features.segment_ids[index, :length]
+            packed_features.position_ids[row_index, start_index:end_index] = np.arange(length)
+            packed_features.pack_ids[row_index, start_index:end_index] = pack_id
+            packed_features.cls_positions[row_index, pack_id - 1] = start_index
+            packed_features.sent_label_ids[row_index, pack_id - 1] = features.sent_label_ids[index]
+            packed_features.sent_masks[row_index, pack_id - 1] = 1
+            start_index = end_index
+    
+    num_tokens = sum(lengths)
+    tf.logging.info("Packed %d examples into %d rows, %.2f examples per row",
+        len(features), len(packed_features), float(len(features)) / max(len(packed_features), 1))
+    tf.logging.info("Packing efficiency = %.2f%% of positions are real tokens, up from %.2f%% without packing",
+        100.0 * num_tokens / max(len(packed_features) * max_seq_length, 1),
+        100.0 * num_tokens / max(len(features) * max_seq_length, 1))
+    
+    return packed_features
+
+def get_content_key(paths):
+    """Gets a key of the content of a list of files."""
+    hasher = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                hasher.update(chunk)
+    
+    return hasher.hexdigest()
+
+class FeatureCache(object):
+    """On-disk cache of converted features, keyed by the content of everything the conversion depends on."""
+    def __init__(self,
+                 cache_dir,
+                 task_name,
+                 resource_paths,
+                 config):
+        """Constructs a FeatureCache.
+        
+        Args:
+          cache_dir: string. Directory the cache entries are written to.
+          task_name: string. Name of the task, used to namespace the entries.
+          resource_paths: list of paths (vocab file, label vocab files) whose content is part of the key.
+          config: dict. Conversion settings (e.g. `do_lower_case`, `max_seq_length`) that are part of the key.
+        """
+        self.cache_dir = cache_dir
+        self.task_name = task_name
+        self.resource_paths = resource_paths
+        self.config = config
+        self.key_map = {}
+        tf.gfile.MakeDirs(cache_dir)
+    
+    def load(self,
+             data_type,
+             data_path):
+        """Loads the cached features for a data file, returns `None` on a cache miss."""
+        entry_path = self._get_entry_path(data_type, data_path)
+        self._evict_stale(data_type, entry_path)
+        if not os.path.exists(entry_path):
+            tf.logging.info("Feature cache miss for %s", data_path)
+            return None
+        
+        try:
+            with np.load(entry_path) as entry:
+                features = InputFeatureColumns(
+                    input_ids=entry["input_ids"],
+                    input_masks=entry["input_masks"],
+                    segment_ids=entry["segment_ids"],
+                    sent_label_ids=entry["sent_label_ids"])
+        except (IOError, ValueError, KeyError) as error:
+            tf.logging.warning("Evicting unreadable feature cache entry %s: %s", entry_path, str(error))
+            os.remove(entry_path)
+            return None
+        
+        tf.logging.info("Feature cache hit for %s (%d features)", data_path, len(features))
+        return features
+    
+    def save(self,
+             data_type,
+             data_path,
+             features):
+        """Writes the features for a data file to the cache."""
+        entry_path = self._get_entry_path(data_type, data_path)
+        self._evict_stale(data_type, entry_path)
+        
+        # Write to a temporary file first so that an interrupted run never leaves a truncated entry behind.
+        temp_path = "{0}.{1}.tmp".format(entry_path, os.getpid())
+        with open(temp_path, "wb") as file:
+            np.savez(file,
+                input_ids=features.input_ids,
+                input_masks=features.input_masks,
+                segment_ids=features.segment_ids,
+                sent_label_ids=features.sent_label_ids)
+        
+        os.rename(temp_path, entry_path)
+        tf.logging.info("Feature cache entry written to %s", entry_path)
+    
+    def _get_entry_path(self,
+                        data_type,
+                        data_path):
+        """Gets the entry path `<data_type>-<task_name>.<setup key>.<content key>.npz`. The setup key hashes the paths
+        of the data and resource files and the config, the content key hashes what is in those files."""
+        if data_path not in self.key_map:
+            setup_paths = [os.path.abspath(path) for path in [data_path] + self.resource_paths]
+            setup_key = hashlib.sha1(json.dumps([setup_paths, self.config], sort_keys=True).encode("utf-8")).hexdigest()
+            
+            self.key_map[data_path] = "{0}.{1}".format(setup_key[:16], get_content_key([data_path] + self.resource_paths))
+        
+        entry_name = "{0}-{1}.{2}.npz".format(data_type, self.task_name, self.key_map[data_path])
+        return os.path.join(self.cache_dir, entry_name)
+    
+    def _evict_stale(self,
+                     data_type,
+                     entry_path):
+        # Only entries with the same setup key are evicted, i.e. ones built from an older version of the same files
+        # with the same settings. Entries of other data dirs or settings (e.g. another `max_seq_length`) are kept,
+        # so that runs alternating between them, or running side by side, keep their caches.
+        entry_prefix = os.path.basename(entry_path).rsplit(".", 2)[0] + "."
+        for entry_name in os.listdir(self.cache_dir):
+            stale_path = os.path.join(self.cache_dir, entry_name)
+            if entry_name.startswith(entry_prefix) and entry_name.endswith(".npz") and stale_path != entry_path:
+                tf.logging.info("Evicting stale feature cache entry %s", stale_path)
+                os.remove(stale_path)
+
+class MemmapFeatureStore(object):
+    """Converted features kept on disk as fixed-width `.npy` matrices, memory-mapped instead of read into memory."""
+    def __init__(self,
+                 feature_dir,
+                 task_name,
+                 resource_paths,
+                 config):
+        """Constructs a MemmapFeatureStore.
+        
+        Args:
+          feature_dir: string. Directory holding one sub-directory of `.npy` files plus `index.json` per data set.
+          task_name: string. Name of the task, used to name the sub-directories.
+          resource_paths: list of paths (vocab file, label vocab files) whose content the features must match.
+          config: dict. Conversion settings (e.g. `do_lower_case`, `max_seq_length`) the features must match.
+        """
+        self.feature_dir = feature_dir
+        self.task_name = task_name
+        self.resource_paths = resource_paths
+        self.config = config
+        self.resource_key = None
+    
+    def load(self,
+             data_type,
+             data_path):
+        """Memory-maps the features of a data set, returns `None` if they are missing or out of date."""
+        data_dir = self._get_data_dir(data_type)
+        index_path = os.path.join(data_dir, "index.json")
+        if not os.path.exists(index_path):
+            tf.logging.info("No memory-mapped features for %s", data_path)
+            return None
+        
+        with open(index_path, "r") as file:
+            index = json.load(file)
+        
+        if (index["config"] != self.config or index["data_stat"] != self._get_data_stat(data_path) or
+            index.get("resource_key") != self._get_resource_key()):
+            tf.logging.info("Memory-mapped features in %s are out of date", data_dir)
+            return None
+        
+        features = InputFeatureColumns.load_memmap(data_dir)
+        tf.logging.info("Memory-mapped %d features from %s", len(features), data_dir)
+        return features
+    
+    def create(self,
+               data_type,
+               num_features,
+               max_seq_length):
+        """Creates empty memory-mapped columns for a data set, to be filled by `convert_examples_to_features`."""
+        data_dir = self._get_data_dir(data_type)
+        index_path = os.path.join(data_dir, "index.json")
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        
+        return InputFeatureColumns.open_memmap(data_dir, num_features, max_seq_length)
+    
+    def commit(self,
+               data_type,
+               data_path,
+               features):
+        """Flushes the columns of a data set and writes its index. The index goes last, so partial writes are never loaded."""
+        data_dir = self._get_data_dir(data_type)
+        features.flush()
+        
+        index = {
+            "num_features": len(features),
+            "data_path": data_path,
+            "data_stat": self._get_data_stat(data_path),
+            "resource_key": self._get_resource_key(),
+            "config": self.config
+        }
+        
+        with open(os.path.join(data_dir, "index.json"), "w") as file:
+            json.dump(index, file, indent=4)
+        
+        tf.logging.info("Memory-mapped features written to %s", data_dir)
+    
+    def _get_data_dir(self,
+                      data_type):
+        return os.path.join(self.feature_dir, "{0}-{1}".format(data_type, self.task_name))
+    
+    def _get_resource_key(self):
+        # The vocab and label files are small, so they are hashed rather than checked by size and mtime like the data file.
+        if self.resource_key is None:
+            self.resource_key = get_content_key(self.resource_paths)
+        
+        return self.resource_key
+    
+    def _get_data_stat(self,
+                       data_path):
+        data_stat = os.stat(data_path)
+        return [data_stat.st_size, int(data_stat.st_mtime)]
+
+class EncoderOutputStore(object):
+    """Outputs of the frozen BERT encoder kept on disk as `.npy` matrices, memory-mapped for head-only training."""
+    def __init__(self,
+                 output_dir,
+                 task_name,
+                 config):
+        """Constructs an EncoderOutputStore.
         
-        feature = convert_single_example(ex_index, example, sent_label_list, max_seq_length, tokenizer)
-        features.append(feature)
+        Args:
+          output_dir: string. Directory holding one sub-directory of `.npy` files plus `index.json` per data set.
+          task_name: string. Name of the task, used to name the sub-directories.
+          config: dict. Encoder and conversion settings (e.g. `init_checkpoint`, `max_seq_length`) the outputs must match.
+        """
+        self.output_dir = output_dir
+        self.task_name = task_name
+        self.config = config
+    
+    def load(self,
+             data_type,
+             data_path):
+        """Memory-maps the encoder outputs of a data set, returns `None` if they are missing or out of date."""
+        data_dir = self._get_data_dir(data_type)
+        index_path = os.path.join(data_dir, "index.json")
+        if not os.path.exists(index_path):
+            tf.logging.info("No stored encoder outputs for %s", data_path)
+            return None
+        
+        with open(index_path, "r") as file:
+            index = json.load(file)
+        
+        if index["config"] != self.config or index["data_stat"] != self._get_data_stat(data_path):
+            tf.logging.info("Stored encoder outputs in %s are out of date", data_dir)
+            return None
+        
+        encoder_outputs = dict([(name, np.load(os.path.join(data_dir, "{0}.npy".format(name)), mmap_mode="r")) for name in index["output_names"]])
+        tf.logging.info("Memory-mapped encoder outputs of %d examples from %s", index["num_examples"], data_dir)
+        return encoder_outputs
+    
+    def create(self,
+               data_type,
+               output_shapes,
+               dtype):
+        """Creates zero-filled memory-mapped arrays of the given shapes, to be filled by `encode_features`."""
+        data_dir = self._get_data_dir(data_type)
+        index_path = os.path.join(data_dir, "index.json")
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        
+        tf.gfile.MakeDirs(data_dir)
+        return dict([(name, np.lib.format.open_memmap(os.path.join(data_dir, "{0}.npy".format(name)), mode="w+", dtype=dtype, shape=shape))
+            for (name, shape) in output_shapes.items()])
+    
+    def commit(self,
+               data_type,
+               data_path,
+               encoder_outputs):
+        """Flushes the encoder outputs of a data set and writes its index. The index goes last, so partial writes are never loaded."""
+        data_dir = self._get_data_dir(data_type)
+        for encoder_output in encoder_outputs.values():
+            encoder_output.flush()
+        
+        index = {
+            "num_examples": len(list(encoder_outputs.values())[0]),
+            "output_names": sorted(encoder_outputs.keys()),
+            "data_path": data_path,
+            "data_stat": self._get_data_stat(data_path),
+            "config": self.config
+        }
+        
+        with open(os.path.join(data_dir, "index.json"), "w") as file:
+            json.dump(index, file, indent=4)
+        
+        tf.logging.info("Encoder outputs written to %s", data_dir)
+    
+    def _get_data_dir(self,
+                      data_type):
+        return os.path.join(self.output_dir, "{0}-{1}".format(data_type, self.task_name))
+    
+    def _get_data_stat(self,
+                       data_path):
+        data_stat = os.stat(data_path)
+        return [data_stat.st_size, int(data_stat.st_mtime)]
+
+def get_features(processor,
+                 data_type,
+                 sent_label_list,
+                 max_seq_length,
+                 tokenizer,
+                 num_workers=1,
+                 feature_cache=None,
+                 feature_store=None):
+    """Gets the features of the train, dev or test set.
+    
+    Features are memory-mapped from `feature_store` if there is one, and converted straight into it when missing.
+    Otherwise they are converted in memory, going through the feature cache if there is one.
+    """
+    data_path = processor.get_data_path(data_type)
+    if feature_store is not None:
+        features = feature_store.load(data_type, data_path)
+        if features is not None:
+            return features
+    elif feature_cache is not None:
+        features = feature_cache.load(data_type, data_path)
+        if features is not None:
+            return features
+    
+    get_examples = {
+        "train": processor.get_train_examples,
+        "dev": processor.get_dev_examples,
+        "test": processor.get_test_examples,
+    }[data_type]
+    
+    examples = get_examples()
+    
+    features = None
+    if feature_store is not None:
+        features = feature_store.create(data_type, len(examples), max_seq_length)
+    
+    features = convert_examples_to_features(
+        examples=examples,
+        sent_label_list=sent_label_list,
+        max_seq_length=max_seq_length,
+        tokenizer=tokenizer,
+        num_workers=num_workers,
+        features=features)
+    
+    if feature_store is not None:
+        feature_store.commit(data_type, data_path, features)
+    elif feature_cache is not None:
+        feature_cache.save(data_type, data_path, features)
     
     return features
 
+def get_bucket_boundaries(bucket_boundaries,
+                          seq_length):
+    """Parses a comma-separated list of bucket lengths, capped at and always ending with `seq_length`."""
+    if not bucket_boundaries:
+        return []
+    
+    boundaries = sorted(set([min(int(boundary), seq_length) for boundary in bucket_boundaries.split(",") if boundary.strip()]))
+    if not boundaries or boundaries[-1] < seq_length:
+        boundaries.append(seq_length)
+    
+    return boundaries
+
+def bucket_by_length(d,
+                     batch_size,
+                     seq_length,
+                     bucket_boundaries,
+                     is_training):
+    """Strips the padding off every example and batches examples of similar length together.
+    
+    With `bucket_boundaries` each batch is padded up to the boundary of its bucket, otherwise examples are
+    grouped in steps of 8 and each batch is only padded to its longest example. Outside of training, each
+    example carries an `example_index` so that predictions can be put back in input order.
+    """
+    seq_names = ["input_ids", "input_masks", "segment_ids"]
+    
+    def _add_index(index,
+                   example):
+        example["example_index"] = tf.to_int32(index)
+        return example
+    
+    def _trim_padding(example):
+        length = tf.reduce_sum(example["input_masks"])
+        for name in seq_names:
+            example[name] = example[name][:length]
+        
+        return example
+    
+    if not is_training:
+        d = d.apply(tf.contrib.data.enumerate_dataset())
+        d = d.map(_add_index)
+    
+    d = d.map(_trim_padding)
+    
+    if bucket_boundaries:
+        # bucket_by_sequence_length() pads every bucket to one less than its upper boundary.
+        boundaries = [boundary + 1 for boundary in bucket_boundaries]
+        pad_to_bucket_boundary = True
+    else:
+        boundaries = list(range(8, seq_length, 8))
+        pad_to_bucket_boundary = False
+    
+    d = d.apply(tf.contrib.data.bucket_by_sequence_length(
+        element_length_func=lambda example: tf.shape(example["input_ids"])[0],
+        bucket_boundaries=boundaries,
+        bucket_batch_sizes=[batch_size] * (len(boundaries) + 1),
+        pad_to_bucket_boundary=pad_to_bucket_boundary))
+    
+    return d
+
 def input_fn_builder(features,
                      seq_length,
                      is_training,
-                     drop_remainder):
+                     drop_remainder,
+                     do_bucketing=False,
+                     bucket_boundaries=None,
+                     shuffle_buffer_size=100,
+                     prefetch_buffer_size=tf.contrib.data.AUTOTUNE):
     """Creates an `input_fn` closure to be passed to TPUEstimator."""
-    all_input_ids = []
-    all_input_masks = []
-    all_segment_ids = []
-    all_sent_label_ids = []
-    
-    for feature in features:
-        all_input_ids.append(feature.input_ids)
-        all_input_masks.append(feature.input_masks)
-        all_segment_ids.append(feature.segment_ids)
-        all_sent_label_ids.append(feature.sent_label_id)
-    
     def input_fn(params):
         batch_size = params["batch_size"]
-        num_examples = len(features)
-
+        
         # This is for demo purposes and does NOT scale to large data sets. We do
         # not use Dataset.from_generator() because that uses tf.py_func which is
         # not TPU compatible. The right way to load data is with TFRecordReader.
+        # The columns are already int32 arrays, so they are handed over without another copy.
         d = tf.data.Dataset.from_tensor_slices({
-            "input_ids": tf.constant(all_input_ids, shape=[num_examples, seq_length], dtype=tf.int32),
-            "input_masks": tf.constant(all_input_masks, shape=[num_examples, seq_length], dtype=tf.int32),
-            "segment_ids": tf.constant(all_segment_ids, shape=[num_examples, seq_length], dtype=tf.int32),
-            "sent_label_ids": tf.constant(all_sent_label_ids, shape=[num_examples], dtype=tf.int32),
+            "input_ids": features.input_ids,
+            "input_masks": features.input_masks,
+            "segment_ids": features.segment_ids,
+            "sent_label_ids": features.sent_label_ids,
         })
         
         if is_training:
-            d = d.repeat()
-            d = d.shuffle(buffer_size=100, seed=np.random.randint(10000))
+            # Reshuffled in a new order every epoch, reproducibly for a given random seed.
+            d = d.apply(tf.contrib.data.shuffle_and_repeat(buffer_size=shuffle_buffer_size, seed=np.random.randint(10000)))
+        
+        if do_bucketing:
+            d = bucket_by_length(d, batch_size, seq_length, bucket_boundaries, is_training)
+        else:
+            d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+        
+        if prefetch_buffer_size != 0:
+            d = d.prefetch(buffer_size=prefetch_buffer_size)
+        return d
+    
+    return input_fn
+
+def packed_input_fn_builder(features,
+                            is_training,
+                            drop_remainder,
+                            shuffle_buffer_size=100,
+                            prefetch_buffer_size=tf.contrib.data.AUTOTUNE):
+    """Creates an `input_fn` closure over `PackedInputFeatures` to be passed to TPUEstimator."""
+    def input_fn(params):
+        batch_size = params["batch_size"]
+        
+        # Like `input_fn_builder`, this puts the rows into the graph, so it is only used with `use_tfrecord` off.
+        d = tf.data.Dataset.from_tensor_slices({
+            "input_ids": features.input_ids,
+            "input_masks": features.input_masks,
+            "segment_ids": features.segment_ids,
+            "position_ids": features.position_ids,
+            "pack_ids": features.pack_ids,
+            "cls_positions": features.cls_positions,
+            "sent_label_ids": features.sent_label_ids,
+            "sent_masks": features.sent_masks,
+        })
+        
+        if is_training:
+            # Reshuffled in a new order every epoch, reproducibly for a given random seed.
+            d = d.apply(tf.contrib.data.shuffle_and_repeat(buffer_size=shuffle_buffer_size, seed=np.random.randint(10000)))
+        
+        d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+        
+        if prefetch_buffer_size != 0:
+            d = d.prefetch(buffer_size=prefetch_buffer_size)
+        return d
+    
+    return input_fn
+
+def memmap_input_fn_builder(features,
+                            seq_length,
+                            is_training,
+                            drop_remainder,
+                            do_bucketing=False,
+                            bucket_boundaries=None,
+                            shuffle_buffer_size=100,
+                            num_parallel_calls=4,
+                            prefetch_buffer_size=tf.contrib.data.AUTOTUNE):
+    """Creates an `input_fn` closure that gathers every batch straight from memory-mapped `InputFeatureColumns`."""
+    def gather_batch(indices):
+        # Only the rows of this batch are read from disk. Sorting the indices keeps the reads mostly sequential.
+        indices = np.sort(indices)
+        return [features.input_ids[indices], features.input_masks[indices], features.segment_ids[indices], features.sent_label_ids[indices]]
+    
+    def input_fn(params):
+        """The actual input function."""
+        batch_size = params["batch_size"]
+        num_examples = len(features)
+        
+        def _gather_features(indices):
+            (input_ids, input_masks, segment_ids, sent_label_ids) = tf.py_func(gather_batch, [indices], [tf.int32] * 4, stateful=False)
+            
+            example_batch_size = batch_size if drop_remainder else None
+            input_ids.set_shape([example_batch_size, seq_length])
+            input_masks.set_shape([example_batch_size, seq_length])
+            segment_ids.set_shape([example_batch_size, seq_length])
+            sent_label_ids.set_shape([example_batch_size])
+            
+            return {
+                "input_ids": input_ids,
+                "input_masks": input_masks,
+                "segment_ids": segment_ids,
+                "sent_label_ids": sent_label_ids,
+            }
+        
+        # The dataset only holds example indices; tf.py_func keeps it off the TPU, but nothing is loaded into memory up front.
+        d = tf.data.Dataset.range(num_examples)
+        if is_training:
+            # Reshuffled in a new order every epoch, reproducibly for a given random seed.
+            d = d.apply(tf.contrib.data.shuffle_and_repeat(buffer_size=shuffle_buffer_size, seed=np.random.randint(10000)))
+        
+        d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+        d = d.map(_gather_features, num_parallel_calls=num_parallel_calls)
+        
+        if do_bucketing:
+            d = d.apply(tf.contrib.data.unbatch())
+            d = bucket_by_length(d, batch_size, seq_length, bucket_boundaries, is_training)
+        
+        if prefetch_buffer_size != 0:
+            d = d.prefetch(buffer_size=prefetch_buffer_size)
+        return d
+    
+    return input_fn
+
+def encoder_output_input_fn_builder(features,
+                                    encoder_outputs,
+                                    is_training,
+                                    drop_remainder,
+                                    shuffle_buffer_size=100,
+                                    num_parallel_calls=4,
+                                    prefetch_buffer_size=tf.contrib.data.AUTOTUNE):
+    """Creates an `input_fn` closure that feeds stored encoder outputs, along with the features, to the task heads."""
+    feature_names = ["input_ids", "input_masks", "segment_ids", "sent_label_ids"]
+    output_names = sorted(encoder_outputs.keys())
+    
+    def gather_batch(indices):
+        # Only the rows of this batch are read from disk. Sorting the indices keeps the reads mostly sequential.
+        indices = np.sort(indices)
+        return ([getattr(features, name)[indices] for name in feature_names] +
+            [encoder_outputs[name][indices].astype(np.float32) for name in output_names])
+    
+    def input_fn(params):
+        """The actual input function."""
+        batch_size = params["batch_size"]
+        num_examples = len(features)
+        
+        def _gather_batch(indices):
+            batch = tf.py_func(gather_batch, [indices], [tf.int32] * len(feature_names) + [tf.float32] * len(output_names), stateful=False)
+            
+            example_batch_size = batch_size if drop_remainder else None
+            shapes = ([getattr(features, name).shape[1:] for name in feature_names] +
+                [encoder_outputs[name].shape[1:] for name in output_names])
+            for tensor, shape in zip(batch, shapes):
+                tensor.set_shape([example_batch_size] + list(shape))
+            
+            return dict(zip(feature_names + output_names, batch))
+        
+        d = tf.data.Dataset.range(num_examples)
+        if is_training:
+            # Reshuffled in a new order every epoch, reproducibly for a given random seed.
+            d = d.apply(tf.contrib.data.shuffle_and_repeat(buffer_size=shuffle_buffer_size, seed=np.random.randint(10000)))
         
         d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+        d = d.map(_gather_batch, num_parallel_calls=num_parallel_calls)
+        
+        if prefetch_buffer_size != 0:
+            d = d.prefetch(buffer_size=prefetch_buffer_size)
+        return d
+    
+    return input_fn
+
+def generator_input_fn_builder(example_fn,
+                               sent_label_list,
+                               seq_length,
+                               tokenizer,
+                               is_training,
+                               drop_remainder,
+                               do_bucketing=False,
+                               bucket_boundaries=None,
+                               shuffle_buffer_size=100,
+                               prefetch_buffer_size=tf.contrib.data.AUTOTUNE,
+                               num_shards=1,
+                               shard_index=0):
+    """Creates an `input_fn` closure that converts examples lazily as `example_fn` yields them."""
+    def feature_generator():
+        for (ex_index, example) in enumerate(example_fn()):
+            if ex_index % num_shards != shard_index:
+                continue
+            
+            feature = convert_single_example(ex_index, example, sent_label_list, seq_length, tokenizer)
+            yield {
+                "input_ids": feature.input_ids,
+                "input_masks": feature.input_masks,
+                "segment_ids": feature.segment_ids,
+                "sent_label_ids": feature.sent_label_id,
+            }
+    
+    def input_fn(params):
+        """The actual input function."""
+        batch_size = params["batch_size"]
+        
+        output_types = {
+            "input_ids": tf.int32,
+            "input_masks": tf.int32,
+            "segment_ids": tf.int32,
+            "sent_label_ids": tf.int32,
+        }
+        output_shapes = {
+            "input_ids": tf.TensorShape([seq_length]),
+            "input_masks": tf.TensorShape([seq_length]),
+            "segment_ids": tf.TensorShape([seq_length]),
+            "sent_label_ids": tf.TensorShape([]),
+        }
+        
+        # Dataset.from_generator() uses tf.py_func, which is not TPU compatible, but it lets training
+        # start while the file is still being read and never holds the whole data set in memory.
+        # The generator is called again on every repeat, so each epoch re-reads the file.
+        d = tf.data.Dataset.from_generator(feature_generator, output_types, output_shapes)
+        
+        if is_training:
+            # Reshuffled in a new order every epoch, reproducibly for a given random seed.
+            d = d.apply(tf.contrib.data.shuffle_and_repeat(buffer_size=shuffle_buffer_size, seed=np.random.randint(10000)))
+        
+        if do_bucketing:
+            d = bucket_by_length(d, batch_size, seq_length, bucket_boundaries, is_training)
+        else:
+            d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+        
+        if prefetch_buffer_size != 0:
+            d = d.prefetch(buffer_size=prefetch_buffer_size)
         return d
     
     return input_fn
@@ -328,35 +1236,154 @@ def file_based_convert_examples_to_features(examples,
                                             sent_label_list,
                                             max_seq_length,
                                             tokenizer,
-                                            output_file):
-    """Convert a set of `InputExample`s to a TFRecord file."""
+                                            output_files,
+                                            num_workers=1):
+    """Convert a set of `InputExample`s to a set of TFRecord shards."""
+    features = convert_examples_to_features(examples, sent_label_list, max_seq_length, tokenizer, num_workers)
+    file_based_write_features(features, output_files)
+
+def file_based_write_features(features,
+                              output_files):
+    """Write `InputFeatureColumns` to a set of TFRecord shards, each holding a contiguous slice of the features."""
     def create_int_feature(values):
         return tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
     
-    writer = tf.python_io.TFRecordWriter(output_file)
+    num_features = len(features)
+    num_shards = len(output_files)
+    for (shard_index, output_file) in enumerate(output_files):
+        writer = tf.python_io.TFRecordWriter(output_file)
+        
+        start_index = shard_index * num_features // num_shards
+        end_index = (shard_index + 1) * num_features // num_shards
+        for feature_index in range(start_index, end_index):
+            if feature_index % 10000 == 0:
+                tf.logging.info("Writing example %d of %d" % (feature_index, num_features))
+            
+            feature = features[feature_index]
+            
+            tf_features = collections.OrderedDict()
+            tf_features["input_ids"] = create_int_feature(feature.input_ids)
+            tf_features["input_masks"] = create_int_feature(feature.input_masks)
+            tf_features["segment_ids"] = create_int_feature(feature.segment_ids)
+            tf_features["sent_label_ids"] = create_int_feature([feature.sent_label_id])
+            
+            tf_example = tf.train.Example(features=tf.train.Features(feature=tf_features))
+            
+            writer.write(tf_example.SerializeToString())
+        
+        writer.close()
+
+def get_tfrecord_files(output_dir,
+                       data_type,
+                       num_shards):
+    """Gets the paths of the TFRecord shards for the train, dev or test set."""
+    return [os.path.join(output_dir, "{0}.tf_record-{1:05d}-of-{2:05d}".format(data_type, shard_index, num_shards))
+        for shard_index in range(num_shards)]
+
+def file_based_write_packed_features(features,
+                                     output_files):
+    """Write `PackedInputFeatures` to a set of TFRecord shards, each holding a contiguous slice of the rows."""
+    def create_int_feature(values):
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    
+    columns = sorted(vars(features).items())
+    num_rows = len(features)
+    num_shards = len(output_files)
+    for (shard_index, output_file) in enumerate(output_files):
+        writer = tf.python_io.TFRecordWriter(output_file)
+        
+        start_index = shard_index * num_rows // num_shards
+        end_index = (shard_index + 1) * num_rows // num_shards
+        for row_index in range(start_index, end_index):
+            if row_index % 10000 == 0:
+                tf.logging.info("Writing packed row %d of %d" % (row_index, num_rows))
+            
+            tf_features = collections.OrderedDict()
+            for (name, column) in columns:
+                tf_features[name] = create_int_feature(column[row_index].tolist())
+            
+            tf_example = tf.train.Example(features=tf.train.Features(feature=tf_features))
+            
+            writer.write(tf_example.SerializeToString())
+        
+        writer.close()
+
+def file_based_packed_input_fn_builder(input_files,
+                                       seq_length,
+                                       max_examples_per_pack,
+                                       is_training,
+                                       drop_remainder,
+                                       num_cpu_threads=4,
+                                       shuffle_buffer_size=100,
+                                       num_parallel_calls=4,
+                                       prefetch_buffer_size=tf.contrib.data.AUTOTUNE):
+    """Creates an `input_fn` closure over TFRecord shards of `PackedInputFeatures` to be passed to TPUEstimator."""
+    name_to_features = {
+        "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
+        "input_masks": tf.FixedLenFeature([seq_length], tf.int64),
+        "segment_ids": tf.FixedLenFeature([seq_length], tf.int64),
+        "position_ids": tf.FixedLenFeature([seq_length], tf.int64),
+        "pack_ids": tf.FixedLenFeature([seq_length], tf.int64),
+        "cls_positions": tf.FixedLenFeature([max_examples_per_pack], tf.int64),
+        "sent_label_ids": tf.FixedLenFeature([max_examples_per_pack], tf.int64),
+        "sent_masks": tf.FixedLenFeature([max_examples_per_pack], tf.int64),
+    }
     
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
+    def _decode_record(record,
+                       name_to_features):
+        """Decodes a record to a TensorFlow example."""
+        example = tf.parse_single_example(record, name_to_features)
+        
+        # tf.Example only supports tf.int64, but the TPU only supports tf.int32. So cast all int64 to int32.
+        for name in list(example.keys()):
+            t = example[name]
+            if t.dtype == tf.int64:
+                t = tf.to_int32(t)
+            example[name] = t
+        
+        return example
     
-        feature = convert_single_example(ex_index, example, sent_label_list, max_seq_length, tokenizer)
+    def input_fn(params):
+        """The actual input function."""
+        batch_size = params["batch_size"]
         
-        features = collections.OrderedDict()
-        features["input_ids"] = create_int_feature(feature.input_ids)
-        features["input_masks"] = create_int_feature(feature.input_masks)
-        features["segment_ids"] = create_int_feature(feature.segment_ids)
-        features["sent_label_ids"] = create_int_feature([feature.sent_label_id])
+        if is_training:
+            d = tf.data.Dataset.from_tensor_slices(tf.constant(input_files))
+            d = d.repeat()
+            d = d.shuffle(buffer_size=len(input_files), seed=np.random.randint(10000))
+            
+            cycle_length = min(num_cpu_threads, len(input_files))
+            d = d.apply(tf.contrib.data.parallel_interleave(
+                tf.data.TFRecordDataset,
+                sloppy=is_training,
+                cycle_length=cycle_length))
+            d = d.shuffle(buffer_size=shuffle_buffer_size, seed=np.random.randint(10000))
+        else:
+            d = tf.data.TFRecordDataset(input_files)
         
-        tf_example = tf.train.Example(features=tf.train.Features(feature=features))
+        d = d.apply(tf.contrib.data.map_and_batch(
+            lambda record: _decode_record(record, name_to_features),
+            batch_size=batch_size,
+            num_parallel_calls=num_parallel_calls,
+            drop_remainder=drop_remainder))
         
-        writer.write(tf_example.SerializeToString())
+        if prefetch_buffer_size != 0:
+            d = d.prefetch(buffer_size=prefetch_buffer_size)
+        return d
     
-    writer.close()
+    return input_fn
 
-def file_based_input_fn_builder(input_file,
+def file_based_input_fn_builder(input_files,
                                 seq_length,
                                 is_training,
-                                drop_remainder):
+                                drop_remainder,
+                                num_cpu_threads=4,
+                                do_bucketing=False,
+                                bucket_boundaries=None,
+                                shuffle_buffer_size=100,
+                                num_parallel_calls=4,
+                                prefetch_buffer_size=tf.contrib.data.AUTOTUNE,
+                                cache_file=None):
     """Creates an `input_fn` closure to be passed to TPUEstimator."""
     name_to_features = {
         "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
@@ -384,22 +1411,322 @@ def file_based_input_fn_builder(input_file,
         batch_size = params["batch_size"]
         
         # For training, we want a lot of parallel reading and shuffling.
-        # For eval, we want no shuffling and parallel reading doesn't matter.
-        d = tf.data.TFRecordDataset(input_file)
-        
+        # For eval, we want no shuffling and the shards are read in order, so that predictions line up with features.
         if is_training:
+            d = tf.data.Dataset.from_tensor_slices(tf.constant(input_files))
             d = d.repeat()
-            d = d.shuffle(buffer_size=100, seed=np.random.randint(10000))
+            d = d.shuffle(buffer_size=len(input_files), seed=np.random.randint(10000))
+            
+            # `sloppy` mode means that the interleaving is not exact. This adds even more randomness to the training pipeline.
+            cycle_length = min(num_cpu_threads, len(input_files))
+            d = d.apply(tf.contrib.data.parallel_interleave(
+                tf.data.TFRecordDataset,
+                sloppy=is_training,
+                cycle_length=cycle_length))
+            d = d.shuffle(buffer_size=shuffle_buffer_size, seed=np.random.randint(10000))
+        else:
+            d = tf.data.TFRecordDataset(input_files)
         
-        d = d.apply(tf.contrib.data.map_and_batch(
-            lambda record: _decode_record(record, name_to_features),
-            batch_size=batch_size,
-            drop_remainder=drop_remainder))
+        if do_bucketing or cache_file is not None:
+            d = d.map(lambda record: _decode_record(record, name_to_features), num_parallel_calls=num_parallel_calls)
+            
+            # The first pass writes the decoded records to `cache_file`, later passes read them back from there.
+            if cache_file is not None:
+                d = d.cache(cache_file)
+            
+            if do_bucketing:
+                d = bucket_by_length(d, batch_size, seq_length, bucket_boundaries, is_training)
+            else:
+                d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+        else:
+            d = d.apply(tf.contrib.data.map_and_batch(
+                lambda record: _decode_record(record, name_to_features),
+                batch_size=batch_size,
+                num_parallel_calls=num_parallel_calls,
+                drop_remainder=drop_remainder))
         
+        if prefetch_buffer_size != 0:
+            d = d.prefetch(buffer_size=prefetch_buffer_size)
         return d
     
     return input_fn
 
+def pad_input_fn_builder(input_fn):
+    """Wraps an eval or predict `input_fn` closure so that every batch has exactly `batch_size` examples.
+    
+    The last batch is padded with all-zero examples, which is what a `PaddingInputExample` converts into, so XLA
+    compiles the model once instead of once more for the last batch. Padded examples have no real tokens, so they
+    count towards no metric, and their `example_index` is -1.
+    """
+    def _input_fn(params):
+        batch_size = params["batch_size"]
+        
+        def pad_batch(features):
+            padded_features = {}
+            for (name, tensor) in features.items():
+                paddings = [[0, batch_size - tf.shape(tensor)[0]]] + [[0, 0]] * (tensor.shape.ndims - 1)
+                padded_tensor = tf.pad(tensor, paddings, constant_values=-1 if name == "example_index" else 0)
+                padded_tensor.set_shape([batch_size] + tensor.shape.as_list()[1:])
+                padded_features[name] = padded_tensor
+            
+            return padded_features
+        
+        return input_fn(params).map(pad_batch)
+    
+    return _input_fn
+
+def get_shuffle_buffer_size(num_examples):
+    """Gets the shuffle buffer size from the `shuffle_buffer_size` flag, where 0 stands for the whole data set."""
+    if FLAGS.shuffle_buffer_size > 0:
+        return FLAGS.shuffle_buffer_size
+    
+    return max(num_examples, 1)
+
+def get_features_key(features):
+    """Gets a key of the content of a set of feature columns. Hashing the columns is much cheaper than writing
+    them out as TFRecords, so this decides whether shards written by an earlier run can be reused."""
+    hasher = hashlib.sha1()
+    for (name, column) in sorted(vars(features).items()):
+        hasher.update("{0}:{1}".format(name, column.shape).encode("utf-8"))
+        hasher.update(np.ascontiguousarray(column, dtype=np.int32).data)
+    
+    hasher.update(str(FLAGS.num_tfrecord_shards).encode("utf-8"))
+    return hasher.hexdigest()
+
+def read_key_file(key_file):
+    """Reads the key stored next to a set of TFRecord shards or an eval cache, returns `None` if there is none."""
+    if not tf.gfile.Exists(key_file):
+        return None
+    
+    with tf.gfile.GFile(key_file, "r") as file:
+        return file.read().strip()
+
+def write_key_file(key_file,
+                   key):
+    with tf.gfile.GFile(key_file, "w") as file:
+        file.write(key)
+
+def get_input_fn(features,
+                 data_type,
+                 is_training,
+                 drop_remainder,
+                 num_shards=1,
+                 shard_index=0):
+    """Creates the `input_fn` for a set of features, going through TFRecord shards unless `use_tfrecord` is off.
+    
+    Memory-mapped features are always read in place. With `num_shards` > 1, only the shard at `shard_index` is read.
+    """
+    if num_shards > 1:
+        features = features.shard(num_shards, shard_index)
+        data_type = "{0}-{1}".format(data_type, shard_index)
+    
+    bucket_boundaries = get_bucket_boundaries(FLAGS.bucket_boundaries, FLAGS.max_seq_length)
+    shuffle_buffer_size = get_shuffle_buffer_size(len(features))
+    if isinstance(features.input_ids, np.memmap):
+        return memmap_input_fn_builder(
+            features=features,
+            seq_length=FLAGS.max_seq_length,
+            is_training=is_training,
+            drop_remainder=drop_remainder,
+            do_bucketing=FLAGS.do_bucketing,
+            bucket_boundaries=bucket_boundaries,
+            shuffle_buffer_size=shuffle_buffer_size,
+            num_parallel_calls=FLAGS.num_parallel_calls,
+            prefetch_buffer_size=FLAGS.prefetch_buffer_size)
+    
+    if not FLAGS.use_tfrecord:
+        return input_fn_builder(
+            features=features,
+            seq_length=FLAGS.max_seq_length,
+            is_training=is_training,
+            drop_remainder=drop_remainder,
+            do_bucketing=FLAGS.do_bucketing,
+            bucket_boundaries=bucket_boundaries,
+            shuffle_buffer_size=shuffle_buffer_size,
+            prefetch_buffer_size=FLAGS.prefetch_buffer_size)
+    
+    input_files = get_tfrecord_files(FLAGS.output_dir, data_type, FLAGS.num_tfrecord_shards)
+    features_key = get_features_key(features)
+    
+    # The key file is removed before the shards are written and written after, so partial shards are never reused.
+    key_file = os.path.join(FLAGS.output_dir, "{0}.tf_record.key".format(data_type))
+    if read_key_file(key_file) == features_key and all([tf.gfile.Exists(input_file) for input_file in input_files]):
+        tf.logging.info("Reusing the TFRecord shards of %s, its features are unchanged", data_type)
+    else:
+        if tf.gfile.Exists(key_file):
+            tf.gfile.Remove(key_file)
+        
+        file_based_write_features(features, input_files)
+        write_key_file(key_file, features_key)
+    
+    cache_file = None
+    if FLAGS.eval_cache_dir and not is_training:
+        # A cache left over from an earlier run is only kept if it was built from the same features.
+        tf.gfile.MakeDirs(FLAGS.eval_cache_dir)
+        cache_file = os.path.join(FLAGS.eval_cache_dir, "{0}.data_cache".format(data_type))
+        cache_key_file = "{0}.key".format(cache_file)
+        if read_key_file(cache_key_file) != features_key:
+            for stale_file in tf.gfile.Glob("{0}*".format(cache_file)):
+                tf.gfile.Remove(stale_file)
+            
+            write_key_file(cache_key_file, features_key)
+    
+    return file_based_input_fn_builder(
+        input_files=input_files,
+        seq_length=FLAGS.max_seq_length,
+        is_training=is_training,
+        drop_remainder=drop_remainder,
+        do_bucketing=FLAGS.do_bucketing,
+        bucket_boundaries=bucket_boundaries,
+        shuffle_buffer_size=shuffle_buffer_size,
+        num_parallel_calls=FLAGS.num_parallel_calls,
+        prefetch_buffer_size=FLAGS.prefetch_buffer_size,
+        cache_file=cache_file)
+
+def get_packed_input_fn(features,
+                        data_type,
+                        is_training,
+                        drop_remainder):
+    """Creates the `input_fn` for a set of `PackedInputFeatures`, going through TFRecord shards unless `use_tfrecord` is off."""
+    shuffle_buffer_size = get_shuffle_buffer_size(len(features))
+    if not FLAGS.use_tfrecord:
+        return packed_input_fn_builder(
+            features=features,
+            is_training=is_training,
+            drop_remainder=drop_remainder,
+            shuffle_buffer_size=shuffle_buffer_size,
+            prefetch_buffer_size=FLAGS.prefetch_buffer_size)
+    
+    # Packing shuffles the rows, so the shards are written anew on every run.
+    input_files = get_tfrecord_files(FLAGS.output_dir, data_type, FLAGS.num_tfrecord_shards)
+    file_based_write_packed_features(features, input_files)
+    
+    return file_based_packed_input_fn_builder(
+        input_files=input_files,
+        seq_length=FLAGS.max_seq_length,
+        max_examples_per_pack=FLAGS.max_examples_per_pack,
+        is_training=is_training,
+        drop_remainder=drop_remainder,
+        shuffle_buffer_size=shuffle_buffer_size,
+        num_parallel_calls=FLAGS.num_parallel_calls,
+        prefetch_buffer_size=FLAGS.prefetch_buffer_size)
+
+def create_packed_encoder(bert_config,
+                          is_training,
+                          input_ids,
+                          segment_ids,
+                          position_ids,
+                          pack_ids,
+                          cls_positions,
+                          use_one_hot_embeddings):
+    """Builds the BERT encoder over rows that each pack several examples.
+    
+    Creates the same variables as `modeling.BertModel`, so checkpoints are interchangeable, but looks up position
+    embeddings per example and uses a block-diagonal attention mask so that packed examples cannot attend to each
+    other. Returns the sequence output and the pooled output at every position in `cls_positions`.
+    """
+    config = copy.deepcopy(bert_config)
+    if not is_training:
+        config.hidden_dropout_prob = 0.0
+        config.attention_probs_dropout_prob = 0.0
+    
+    input_shape = modeling.get_shape_list(input_ids, expected_rank=2)
+    batch_size = input_shape[0]
+    seq_length = input_shape[1]
+    
+    with tf.variable_scope("bert"):
+        with tf.variable_scope("embeddings"):
+            embedding_output, _ = modeling.embedding_lookup(
+                input_ids=input_ids,
+                vocab_size=config.vocab_size,
+                embedding_size=config.hidden_size,
+                initializer_range=config.initializer_range,
+                word_embedding_name="word_embeddings",
+                use_one_hot_embeddings=use_one_hot_embeddings)
+            
+            token_type_table = tf.get_variable(
+                name="token_type_embeddings",
+                shape=[config.type_vocab_size, config.hidden_size],
+                initializer=modeling.create_initializer(config.initializer_range))
+            one_hot_segment_ids = tf.one_hot(tf.reshape(segment_ids, [-1]), depth=config.type_vocab_size)
+            token_type_embeddings = tf.matmul(one_hot_segment_ids, token_type_table)
+            embedding_output += tf.reshape(token_type_embeddings, [batch_size, seq_length, config.hidden_size])
+            
+            # BertModel slices the first `seq_length` position embeddings; here positions restart with every packed example.
+            full_position_embeddings = tf.get_variable(
+                name="position_embeddings",
+                shape=[config.max_position_embeddings, config.hidden_size],
+                initializer=modeling.create_initializer(config.initializer_range))
+            embedding_output += tf.gather(full_position_embeddings, position_ids)
+            
+            embedding_output = modeling.layer_norm_and_dropout(embedding_output, config.hidden_dropout_prob)
+        
+        with tf.variable_scope("encoder"):
+            # A token attends only to tokens with the same pack id. Padding has pack id 0 and is never attended to.
+            attention_mask = tf.cast(tf.logical_and(
+                tf.equal(tf.expand_dims(pack_ids, axis=2), tf.expand_dims(pack_ids, axis=1)),
+                tf.expand_dims(tf.not_equal(pack_ids, 0), axis=1)), dtype=tf.float32)
+            
+            all_encoder_layers = modeling.transformer_model(
+                input_tensor=embedding_output,
+                attention_mask=attention_mask,
+                hidden_size=config.hidden_size,
+                num_hidden_layers=config.num_hidden_layers,
+                num_attention_heads=config.num_attention_heads,
+                intermediate_size=config.intermediate_size,
+                intermediate_act_fn=modeling.get_activation(config.hidden_act),
+                hidden_dropout_prob=config.hidden_dropout_prob,
+                attention_probs_dropout_prob=config.attention_probs_dropout_prob,
+                initializer_range=config.initializer_range,
+                do_return_all_layers=True)
+        
+        sequence_output = all_encoder_layers[-1]
+        
+        with tf.variable_scope("pooler"):
+            cls_output = tf.batch_gather(sequence_output, cls_positions)
+            pooled_output = tf.layers.dense(
+                cls_output,
+                config.hidden_size,
+                activation=tf.tanh,
+                kernel_initializer=modeling.create_initializer(config.initializer_range))
+    
+    return sequence_output, pooled_output
+
+def get_head_input_fn(features,
+                      data_type,
+                      data_path,
+                      is_training,
+                      drop_remainder,
+                      encoder_estimator,
+                      encoder_output_store,
+                      hidden_size):
+    """Creates the `input_fn` that feeds the task heads from stored encoder outputs, encoding the data set first if needed."""
+    encoder_outputs = encoder_output_store.load(data_type, data_path)
+    if encoder_outputs is None:
+        dtype = np.float16 if FLAGS.encoder_output_float16 else np.float32
+        encoder_outputs = encode_features(encoder_estimator, encoder_output_store, features, data_type, data_path, hidden_size, dtype)
+    
+    return encoder_output_input_fn_builder(
+        features=features,
+        encoder_outputs=encoder_outputs,
+        is_training=is_training,
+        drop_remainder=drop_remainder,
+        shuffle_buffer_size=get_shuffle_buffer_size(len(features)),
+        num_parallel_calls=FLAGS.num_parallel_calls,
+        prefetch_buffer_size=FLAGS.prefetch_buffer_size)
+
+def create_encoder_variables(bert_config):
+    """Creates the BERT variables without feeding the encoder anything, for heads trained from stored encoder outputs.
+    
+    The variables are restored from `init_checkpoint` and saved along with the heads, so the checkpoints can still
+    predict from raw input and be exported.
+    """
+    modeling.BertModel(
+        config=bert_config,
+        is_training=False,
+        input_ids=tf.zeros([1, 1], dtype=tf.int32),
+        use_one_hot_embeddings=False)
+
 def create_model(bert_config,
                  input_ids,
                  input_masks,
@@ -407,22 +1734,43 @@ def create_model(bert_config,
                  sent_label_ids,
                  sent_label_list,
                  mode,
-                 use_tpu):
-    """Creates a Classifier model."""
+                 use_tpu,
+                 position_ids=None,
+                 pack_ids=None,
+                 cls_positions=None,
+                 sent_masks=None,
+                 pooled_output=None):
+    """Creates a Classifier model. Rows pack several examples if `pack_ids` is given, stored encoder outputs are used if `pooled_output` is given."""
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
-    model = modeling.BertModel(
-        config=bert_config,
-        is_training=is_training,
-        input_ids=input_ids,
-        input_mask=input_masks,
-        token_type_ids=segment_ids,
-        use_one_hot_embeddings=use_tpu)
+    if pooled_output is not None:
+        create_encoder_variables(bert_config)
+        sent_masks = tf.reduce_max(input_masks, axis=-1)
+    elif pack_ids is None:
+        model = modeling.BertModel(
+            config=bert_config,
+            is_training=is_training,
+            input_ids=input_ids,
+            input_mask=input_masks,
+            token_type_ids=segment_ids,
+            use_one_hot_embeddings=use_tpu)
+        
+        # If you want to use sentence-level output, use model.get_pooled_output()
+        # If you want to use token-level output, use model.get_sequence_output()
+        pooled_output = model.get_pooled_output()
+        sent_masks = tf.reduce_max(input_masks, axis=-1)
+    else:
+        _, pooled_output = create_packed_encoder(bert_config, is_training, input_ids,
+            segment_ids, position_ids, pack_ids, cls_positions, use_one_hot_embeddings=use_tpu)
+        
+        # The sentence head sees one row per packed example, flattened so it scores them just like unpacked rows.
+        pooled_output = tf.reshape(pooled_output, [-1, bert_config.hidden_size])
+        sent_masks = tf.reshape(sent_masks, [-1])
+        if sent_label_ids is not None:
+            sent_label_ids = tf.reshape(sent_label_ids, [-1])
     
-    # If you want to use sentence-level output, use model.get_pooled_output()
-    # If you want to use token-level output, use model.get_sequence_output()
     with tf.variable_scope("sent", reuse=tf.AUTO_REUSE):
-        sent_result = model.get_pooled_output()
-        sent_result_mask = tf.cast(tf.reduce_max(input_masks, axis=-1, keepdims=True), dtype=tf.float32)
+        sent_result = pooled_output
+        sent_result_mask = tf.cast(tf.expand_dims(sent_masks, axis=-1), dtype=tf.float32)
         
         sent_kernel_initializer = tf.glorot_uniform_initializer(seed=np.random.randint(10000), dtype=tf.float32)
         sent_bias_initializer = tf.zeros_initializer
@@ -448,7 +1796,7 @@ def create_model(bert_config,
     if sent_label_ids is not None:
         with tf.variable_scope("sent_loss", reuse=tf.AUTO_REUSE):
             sent_label = tf.cast(sent_label_ids, dtype=tf.float32)
-            sent_label_mask = tf.cast(tf.reduce_max(input_masks, axis=-1), dtype=tf.float32)
+            sent_label_mask = tf.cast(sent_masks, dtype=tf.float32)
             masked_sent_label = tf.cast(sent_label * sent_label_mask, dtype=tf.int32)
             sent_cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=masked_sent_label, logits=masked_sent_predict)
             sent_loss = tf.reduce_sum(sent_cross_entropy * sent_label_mask) / tf.reduce_sum(tf.reduce_max(sent_label_mask, axis=-1))
@@ -456,13 +1804,144 @@ def create_model(bert_config,
     
     return loss, sent_predict_ids, sent_predict_scores, sent_predict_probs
 
+def get_frozen_variables(tvars,
+                         freeze_embeddings,
+                         freeze_layers):
+    """Gets the BERT variables excluded from training: the embeddings and/or the bottom `freeze_layers` encoder layers."""
+    frozen_scopes = ["bert/encoder/layer_{0}/".format(layer_index) for layer_index in range(freeze_layers)]
+    if freeze_embeddings:
+        frozen_scopes.append("bert/embeddings/")
+    
+    return [tvar for tvar in tvars if any([tvar.name.startswith(frozen_scope) for frozen_scope in frozen_scopes])]
+
+def all_reduce_gradients(grads,
+                         tvars,
+                         num_workers):
+    """Averages gradients across all data-parallel workers.
+    
+    The gradients are flattened into a single tensor, so every step takes one collective all-reduce
+    instead of one per variable.
+    """
+    flat_grads = [tf.reshape(tf.convert_to_tensor(grad), [-1]) for grad in grads]
+    grad_sizes = [tvar.shape.num_elements() for tvar in tvars]
+    reduced_grads = collective_ops.all_reduce(tf.concat(flat_grads, axis=0), group_size=num_workers,
+        group_key=1, instance_key=1, merge_op="Add", final_op="Div")
+    return [tf.reshape(grad, tvar.shape) for grad, tvar in zip(tf.split(reduced_grads, grad_sizes), tvars)]
+
+def create_optimizer(loss,
+                     init_lr,
+                     num_train_steps,
+                     num_warmup_steps,
+                     use_tpu,
+                     gradient_accumulation_steps=1,
+                     num_workers=1):
+    """Creates an optimizer training op, accumulating gradients over `gradient_accumulation_steps` micro-batches.
+    
+    This mirrors `optimization.create_optimizer`, except that the averaged gradients of all micro-batches are applied
+    once every `gradient_accumulation_steps` global steps. The global step counts micro-batches, while
+    `num_train_steps` and `num_warmup_steps` count optimizer steps, so the learning rate schedule matches a run
+    with the whole batch in one step. With `num_workers` > 1, the gradients are averaged across workers before
+    every update.
+    """
+    if gradient_accumulation_steps <= 1 and num_workers <= 1:
+        return optimization.create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu)
+    
+    global_step = tf.train.get_or_create_global_step()
+    optimizer_step = tf.floordiv(global_step, gradient_accumulation_steps)
+    
+    learning_rate = tf.constant(value=init_lr, shape=[], dtype=tf.float32)
+    learning_rate = tf.train.polynomial_decay(learning_rate, optimizer_step, num_train_steps, end_learning_rate=0.0, power=1.0, cycle=False)
+    
+    if num_warmup_steps:
+        optimizer_steps_int = tf.cast(optimizer_step, tf.int32)
+        warmup_steps_int = tf.constant(num_warmup_steps, dtype=tf.int32)
+        
+        optimizer_steps_float = tf.cast(optimizer_steps_int, tf.float32)
+        warmup_steps_float = tf.cast(warmup_steps_int, tf.float32)
+        
+        warmup_percent_done = optimizer_steps_float / warmup_steps_float
+        warmup_learning_rate = init_lr * warmup_percent_done
+        
+        is_warmup = tf.cast(optimizer_steps_int < warmup_steps_int, tf.float32)
+        learning_rate = ((1.0 - is_warmup) * learning_rate + is_warmup * warmup_learning_rate)
+    
+    optimizer = optimization.AdamWeightDecayOptimizer(
+        learning_rate=learning_rate,
+        weight_decay_rate=0.01,
+        beta_1=0.9,
+        beta_2=0.999,
+        epsilon=1e-6,
+        exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"])
+    
+    if use_tpu:
+        optimizer = tf.contrib.tpu.CrossShardOptimizer(optimizer)
+    
+    tvars = tf.trainable_variables()
+    grads = tf.gradients(loss, tvars)
+    
+    # Variables the loss does not depend on (e.g. an unused pooler) have no gradient and are left alone.
+    grads_and_vars = [(grad, tvar) for grad, tvar in zip(grads, tvars) if grad is not None]
+    
+    def apply_gradients(grads):
+        if num_workers > 1:
+            grads = all_reduce_gradients(grads, [tvar for _, tvar in grads_and_vars], num_workers)
+        
+        # This is how the model was pre-trained.
+        (clipped_grads, _) = tf.clip_by_global_norm(grads, clip_norm=1.0)
+        return optimizer.apply_gradients(zip(clipped_grads, [tvar for _, tvar in grads_and_vars]), global_step=global_step)
+    
+    if gradient_accumulation_steps <= 1:
+        update_op = apply_gradients([grad for grad, _ in grads_and_vars])
+    else:
+        accum_grads = []
+        accumulate_ops = []
+        for grad, tvar in grads_and_vars:
+            accum_grad = tf.get_variable(
+                name="gradient_accumulation/{0}".format(tvar.op.name),
+                shape=tvar.shape,
+                dtype=tf.float32,
+                initializer=tf.zeros_initializer(),
+                trainable=False)
+            
+            accum_grads.append(accum_grad)
+            accumulate_ops.append(accum_grad.assign_add(tf.convert_to_tensor(grad) / gradient_accumulation_steps))
+        
+        def apply_accumulated_gradients():
+            apply_op = apply_gradients([accum_grad.read_value() for accum_grad in accum_grads])
+            with tf.control_dependencies([apply_op]):
+                return tf.group(*[accum_grad.assign(tf.zeros_like(accum_grad)) for accum_grad in accum_grads])
+        
+        # Workers only all-reduce on update steps, which every worker reaches at the same global step.
+        is_update_step = tf.equal(tf.mod(global_step + 1, gradient_accumulation_steps), 0)
+        with tf.control_dependencies(accumulate_ops):
+            update_op = tf.cond(is_update_step, apply_accumulated_gradients, tf.no_op)
+    
+    # Like `optimization.create_optimizer`, the optimizer does not advance the global step itself.
+    with tf.control_dependencies([update_op]):
+        train_op = global_step.assign(global_step + 1)
+    
+    return train_op
+
+def get_jit_scope(use_xla):
+    """Gets a scope that marks the ops created in it for XLA compilation if `use_xla`. The marks are part of the graph,
+    so a SavedModel exported from it is compiled wherever it is served. Otherwise the scope does nothing."""
+    if use_xla:
+        return tf.contrib.compiler.jit.experimental_jit_scope()
+    
+    return contextlib.ExitStack()
+
 def model_fn_builder(bert_config,
                      sent_label_list,
                      init_checkpoint,
                      learning_rate,
                      num_train_steps,
                      num_warmup_steps,
-                     use_tpu):
+                     use_tpu,
+                     gradient_accumulation_steps=1,
+                     num_workers=1,
+                     freeze_embeddings=False,
+                     freeze_layers=0,
+                     use_xla=False):
     """Returns `model_fn` closure for TPUEstimator."""
     def model_fn(features,
                  labels,
@@ -478,8 +1957,12 @@ def model_fn_builder(bert_config,
         segment_ids = features["segment_ids"]
         sent_label_ids = features["sent_label_ids"] if mode in [tf.estimator.ModeKeys.TRAIN, tf.estimator.ModeKeys.EVAL] else None
         
-        loss, sent_predict_ids, sent_predict_scores, sent_predict_probs = create_model(bert_config,
-            input_ids, input_masks, segment_ids, sent_label_ids, sent_label_list, mode, use_tpu)
+        with get_jit_scope(use_xla):
+            loss, sent_predict_ids, sent_predict_scores, sent_predict_probs = create_model(bert_config,
+                input_ids, input_masks, segment_ids, sent_label_ids, sent_label_list, mode, use_tpu,
+                position_ids=features.get("position_ids"), pack_ids=features.get("pack_ids"),
+                cls_positions=features.get("cls_positions"), sent_masks=features.get("sent_masks"),
+                pooled_output=features.get("pooled_output"))
         
         tvars = tf.trainable_variables()
         initialized_variable_names = {}
@@ -497,17 +1980,31 @@ def model_fn_builder(bert_config,
         else:
             tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
         
+        frozen_variables = get_frozen_variables(tvars, freeze_embeddings, freeze_layers)
+        
         tf.logging.info("**** Trainable Variables ****")
         for var in tvars:
             init_string = ""
             if var.name in initialized_variable_names:
                 init_string = ", *INIT_FROM_CKPT*"
             
+            if var in frozen_variables:
+                init_string += ", *FROZEN*"
+            
             tf.logging.info("  name = %s, shape = %s%s", var.name, var.shape, init_string)
         
         output_spec = None        
         if mode == tf.estimator.ModeKeys.TRAIN:
-            train_op = optimization.create_optimizer(loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu)
+            # The optimizer only differentiates with respect to trainable variables, so taking the frozen ones out of the
+            # collection prunes the backward pass below the frozen boundary and creates no Adam slots for them.
+            trainable_variables = tf.get_collection_ref(tf.GraphKeys.TRAINABLE_VARIABLES)
+            for var in frozen_variables:
+                trainable_variables.remove(var)
+            
+            if not use_tpu:
+                add_training_stats(input_masks)
+            
+            train_op = create_optimizer(loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu, gradient_accumulation_steps, num_workers)
             output_spec = tf.contrib.tpu.TPUEstimatorSpec(
                 mode=mode,
                 loss=loss,
@@ -515,8 +2012,9 @@ def model_fn_builder(bert_config,
                 scaffold_fn=scaffold_fn)
         elif mode == tf.estimator.ModeKeys.EVAL:
             def metric_fn(sent_label_ids,
-                          sent_predict_ids):
-                sent_accuracy = tf.metrics.accuracy(labels=sent_label_ids, predictions=sent_predict_ids)
+                          sent_predict_ids,
+                          sent_masks):
+                sent_accuracy = tf.metrics.accuracy(labels=sent_label_ids, predictions=sent_predict_ids, weights=sent_masks)
                 
                 metric = {
                     "sent_accuracy": sent_accuracy,
@@ -524,20 +2022,27 @@ def model_fn_builder(bert_config,
                 
                 return metric
             
-            eval_metrics = (metric_fn, [sent_label_ids, sent_predict_ids])
+            # Examples without real tokens pad the last batch and are left out.
+            sent_masks = tf.reduce_max(input_masks, axis=-1)
+            eval_metrics = (metric_fn, [sent_label_ids, sent_predict_ids, sent_masks])
             output_spec = tf.contrib.tpu.TPUEstimatorSpec(
                 mode=mode,
                 loss=loss,
                 eval_metrics=eval_metrics,
                 scaffold_fn=scaffold_fn)
         else:
+            predictions = {
+                "sent_predict_id": sent_predict_ids,
+                "sent_predict_score": sent_predict_scores,
+                "sent_predict_prob": sent_predict_probs
+            }
+            
+            if "example_index" in features:
+                predictions["example_index"] = features["example_index"]
+            
             output_spec = tf.contrib.tpu.TPUEstimatorSpec(
                 mode=mode,
-                predictions={
-                    "sent_predict_id": sent_predict_ids,
-                    "sent_predict_score": sent_predict_scores,
-                    "sent_predict_prob": sent_predict_probs
-                },
+                predictions=predictions,
                 scaffold_fn=scaffold_fn)
         
         return output_spec
@@ -564,6 +2069,65 @@ def get_masked_data(data_ids,
     
     return masked_data_ids
 
+def encoder_model_fn_builder(bert_config,
+                             init_checkpoint):
+    """Returns a `model_fn` closure for TPUEstimator that only runs the BERT encoder and predicts its outputs."""
+    def model_fn(features,
+                 labels,
+                 mode,
+                 params):  # pylint: disable=unused-argument
+        """The `model_fn` for TPUEstimator."""
+        model = modeling.BertModel(
+            config=bert_config,
+            is_training=False,
+            input_ids=features["input_ids"],
+            input_mask=features["input_masks"],
+            token_type_ids=features["segment_ids"],
+            use_one_hot_embeddings=False)
+        
+        tvars = tf.trainable_variables()
+        (assignment_map, _) = modeling.get_assignment_map_from_checkpoint(tvars, init_checkpoint)
+        tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+        
+        predictions = { "pooled_output": model.get_pooled_output() }
+        
+        if "example_index" in features:
+            predictions["example_index"] = features["example_index"]
+        
+        return tf.contrib.tpu.TPUEstimatorSpec(mode=mode, predictions=predictions)
+    
+    return model_fn
+
+def encode_features(encoder_estimator,
+                    encoder_output_store,
+                    features,
+                    data_type,
+                    data_path,
+                    hidden_size,
+                    dtype):
+    """Runs the frozen encoder once over a set of features and stores its outputs, returns them memory-mapped."""
+    output_shapes = { "pooled_output": [len(features), hidden_size] }
+    encoder_outputs = encoder_output_store.create(data_type, output_shapes, dtype)
+    
+    input_fn = get_input_fn(
+        features=features,
+        data_type=data_type,
+        is_training=False,
+        drop_remainder=False)
+    
+    for (index, result) in enumerate(encoder_estimator.predict(input_fn=input_fn)):
+        if index % 10000 == 0:
+            tf.logging.info("Encoding example %d of %d" % (index, len(features)))
+        
+        # Bucketed batches come out of order and only as long as they need to be.
+        example_index = result.get("example_index", index)
+        for name in output_shapes.keys():
+            encoder_output = result[name]
+            encoder_outputs[name][example_index, :len(encoder_output)] = encoder_output
+    
+    encoder_output_store.commit(data_type, data_path, encoder_outputs)
+    return encoder_output_store.load(data_type, data_path)
+
 def serving_input_fn():
     with tf.variable_scope("export"):
         features = {
@@ -574,6 +2138,263 @@ def serving_input_fn():
         
         return tf.estimator.export.build_raw_serving_input_receiver_fn(features)()
 
+class ProfileHook(tf.train.SessionRunHook):
+    """Captures a full trace of the steps in [`start_step`, `end_step`) of a train or predict call, counting from its
+    first step, and writes each one to `output_dir` as a timeline in Chrome trace format. The timelines can be opened
+    in chrome://tracing or summarized with tool/profile_summary.py."""
+    def __init__(self,
+                 output_dir,
+                 start_step,
+                 end_step):
+        self.output_dir = output_dir
+        self.start_step = start_step
+        self.end_step = end_step
+    
+    def begin(self):
+        self.step = 0
+        tf.gfile.MakeDirs(self.output_dir)
+    
+    def before_run(self,
+                   run_context):
+        if self.start_step <= self.step < self.end_step:
+            return tf.train.SessionRunArgs(None, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))
+        
+        return None
+    
+    def after_run(self,
+                  run_context,
+                  run_values):
+        if self.start_step <= self.step < self.end_step:
+            trace = timeline.Timeline(run_values.run_metadata.step_stats).generate_chrome_trace_format()
+            trace_path = os.path.join(self.output_dir, "timeline-{0}.json".format(self.step))
+            with tf.gfile.GFile(trace_path, "w") as file:
+                file.write(trace)
+            
+            tf.logging.info("Wrote the timeline of step %d to %s", self.step, trace_path)
+        
+        self.step += 1
+
+def get_profile_hooks(profile_steps,
+                      output_dir):
+    """Gets the hooks capturing the `<start>:<end>` step window of `profile_steps` into `output_dir`, none if it is not set."""
+    if not profile_steps:
+        return []
+    
+    (start_step, end_step) = [int(step) for step in profile_steps.split(":")]
+    return [ProfileHook(output_dir, start_step, end_step)]
+
+def add_training_stats(input_mask):
+    """Adds the per-batch stats `TrainingStatsHook` reads to the graph: the numbers of examples, real and padded tokens,
+    and when the batch came out of the input pipeline."""
+    with tf.name_scope("training_stats"):
+        stats = {
+            "num_examples": tf.shape(input_mask)[0],
+            "num_real_tokens": tf.reduce_sum(tf.cast(input_mask, dtype=tf.int64)),
+            "num_tokens": tf.size(input_mask, out_type=tf.int64)
+        }
+        
+        # Runs as soon as the batch is out of the input pipeline, the rest of the step is compute.
+        with tf.control_dependencies([input_mask]):
+            stats["input_ready_time"] = tf.timestamp()
+    
+    for name in TRAINING_STATS:
+        tf.add_to_collection("training_stats/{0}".format(name), stats[name])
+
+class TrainingStatsHook(tf.train.SessionRunHook):
+    """Records the throughput and padding efficiency of training.
+    
+    Every `every_n_steps` steps, the examples/sec, real (non-pad) tokens/sec, padding ratio, the time steps wait on the
+    input pipeline versus compute and the peak RSS are logged and written as summaries to `output_dir`. When training
+    ends, the stats of the whole run and of every interval are written to `report_path` as JSON.
+    """
+    def __init__(self,
+                 output_dir,
+                 report_path,
+                 every_n_steps=100):
+        self.output_dir = output_dir
+        self.report_path = report_path
+        self.every_n_steps = every_n_steps
+    
+    def begin(self):
+        self.global_step = tf.train.get_or_create_global_step()
+        self.stats = dict([(name, tf.get_collection("training_stats/{0}".format(name))[0]) for name in TRAINING_STATS])
+        self.summary_writer = tf.summary.FileWriterCache.get(self.output_dir)
+        self.interval_totals = self._create_totals()
+        self.run_totals = self._create_totals()
+        self.history = []
+        self.last_global_step = None
+        self.run_start_time = None
+    
+    def before_run(self,
+                   run_context):
+        self.run_start_time = time.time()
+        return tf.train.SessionRunArgs(dict(self.stats, global_step=self.global_step))
+    
+    def after_run(self,
+                  run_context,
+                  run_values):
+        run_end_time = time.time()
+        results = run_values.results
+        if self.last_global_step is None:
+            # The first step also starts the input pipeline and warms up the graph, so it is left out.
+            self.last_global_step = results["global_step"]
+            return
+        
+        step_secs = run_end_time - self.run_start_time
+        input_wait_secs = min(max(results["input_ready_time"] - self.run_start_time, 0.0), step_secs)
+        padding_ratio = 1.0 - float(results["num_real_tokens"]) / max(float(results["num_tokens"]), 1.0)
+        for totals in [self.interval_totals, self.run_totals]:
+            totals["steps"] += 1
+            totals["examples"] += int(results["num_examples"])
+            totals["real_tokens"] += int(results["num_real_tokens"])
+            totals["tokens"] += int(results["num_tokens"])
+            totals["input_wait_secs"] += input_wait_secs
+            totals["compute_secs"] += step_secs - input_wait_secs
+            totals["max_padding_ratio"] = max(totals["max_padding_ratio"], padding_ratio)
+        
+        if results["global_step"] - self.last_global_step >= self.every_n_steps:
+            self._write_stats(self.interval_totals, results["global_step"])
+            self.interval_totals = self._create_totals()
+            self.last_global_step = results["global_step"]
+    
+    def end(self,
+            session):
+        global_step = int(session.run(self.global_step))
+        if self.interval_totals["steps"] > 0:
+            self._write_stats(self.interval_totals, global_step)
+        
+        report = {
+            "global_step": global_step,
+            "run": self._get_stats(self.run_totals),
+            "intervals": self.history
+        }
+        
+        write_to_json(report, self.report_path)
+    
+    def _create_totals(self):
+        return {
+            "steps": 0,
+            "examples": 0,
+            "real_tokens": 0,
+            "tokens": 0,
+            "input_wait_secs": 0.0,
+            "compute_secs": 0.0,
+            "max_padding_ratio": 0.0
+        }
+    
+    def _get_stats(self,
+                   totals):
+        step_secs = max(totals["input_wait_secs"] + totals["compute_secs"], 1e-6)
+        steps = max(totals["steps"], 1)
+        return {
+            "steps": totals["steps"],
+            "examples_per_sec": totals["examples"] / step_secs,
+            "real_tokens_per_sec": totals["real_tokens"] / step_secs,
+            "padding_ratio": 1.0 - float(totals["real_tokens"]) / max(float(totals["tokens"]), 1.0),
+            "max_padding_ratio": totals["max_padding_ratio"],
+            "input_wait_secs_per_step": totals["input_wait_secs"] / steps,
+            "compute_secs_per_step": totals["compute_secs"] / steps,
+            "input_wait_ratio": totals["input_wait_secs"] / step_secs,
+            # ru_maxrss is in kilobytes on Linux.
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        }
+    
+    def _write_stats(self,
+                     totals,
+                     global_step):
+        stats = self._get_stats(totals)
+        tf.logging.info("Training stats: %.1f examples/sec, %.1f real tokens/sec, padding %.1f%% (max %.1f%%), "
+            "input wait %.1f%% of step time, peak RSS %.0f MB" % (stats["examples_per_sec"], stats["real_tokens_per_sec"],
+            100.0 * stats["padding_ratio"], 100.0 * stats["max_padding_ratio"], 100.0 * stats["input_wait_ratio"], stats["peak_rss_mb"]))
+        
+        summary = tf.Summary(value=[tf.Summary.Value(tag="training_stats/{0}".format(name), simple_value=value)
+            for (name, value) in sorted(stats.items()) if name != "steps"])
+        self.summary_writer.add_summary(summary, global_step)
+        self.history.append(dict(stats, global_step=int(global_step)))
+
+class BestCheckpointExporter(tf.estimator.Exporter):
+    """Exports the evaluated checkpoint to `export_dir` whenever it improves on the best `metric_name` so far.
+    
+    Every export goes into a new timestamped directory, so the latest model version under `export_dir`, which is
+    the one TF Serving loads, is always the best one. The best metric is kept in `best_metric.json` next to the exports,
+    so a restarted run does not export a checkpoint that is worse than an earlier export.
+    """
+    def __init__(self,
+                 export_dir,
+                 metric_name):
+        self.export_dir = export_dir
+        self.metric_name = metric_name
+        self.best_metric = None
+        
+        self.best_metric_path = os.path.join(export_dir, "best_metric.json")
+        if tf.gfile.Exists(self.best_metric_path):
+            with tf.gfile.GFile(self.best_metric_path, "r") as file:
+                best_export = json.load(file)
+            
+            if best_export["metric_name"] == metric_name:
+                self.best_metric = best_export["best_metric"]
+                tf.logging.info("Restored the best %s = %s of %s", metric_name, str(self.best_metric), best_export["export_path"])
+    
+    @property
+    def name(self):
+        return "best"
+    
+    def export(self,
+               estimator,
+               export_path,
+               checkpoint_path,
+               eval_result,
+               is_the_final_export):
+        metric = eval_result[self.metric_name]
+        if self.best_metric is not None and metric <= self.best_metric:
+            tf.logging.info("Not exporting %s, %s = %s does not improve on %s", checkpoint_path, self.metric_name, str(metric), str(self.best_metric))
+            return None
+        
+        tf.logging.info("Exporting %s with the best %s = %s", checkpoint_path, self.metric_name, str(metric))
+        tf.gfile.MakeDirs(self.export_dir)
+        export_path = estimator.export_savedmodel(self.export_dir, serving_input_fn, checkpoint_path=checkpoint_path, as_text=False)
+        
+        # Written only once the export is complete, so a failed export never raises the bar for the next one.
+        self.best_metric = float(metric)
+        best_export = {
+            "metric_name": self.metric_name,
+            "best_metric": self.best_metric,
+            "checkpoint_path": checkpoint_path,
+            "export_path": export_path.decode("utf-8") if isinstance(export_path, bytes) else export_path
+        }
+        
+        with tf.gfile.GFile(self.best_metric_path, "w") as file:
+            json.dump(best_export, file, indent=4)
+        
+        return export_path
+
+def train_and_evaluate(estimator,
+                       train_input_fn,
+                       eval_input_fn,
+                       max_steps,
+                       save_checkpoints_steps,
+                       eval_metric,
+                       early_stopping_patience,
+                       export_dir,
+                       train_hooks=None):
+    """Trains the model, evaluating it on the dev set after every checkpoint. Training stops early once `eval_metric`
+    has not improved for `early_stopping_patience` evaluations, and the best checkpoint is exported to `export_dir`."""
+    hooks = list(train_hooks) if train_hooks else []
+    if early_stopping_patience > 0:
+        hooks.append(tf.contrib.estimator.stop_if_no_increase_hook(estimator, eval_metric,
+            max_steps_without_increase=early_stopping_patience * save_checkpoints_steps,
+            run_every_secs=None, run_every_steps=save_checkpoints_steps))
+    
+    exporters = []
+    if export_dir:
+        exporters.append(BestCheckpointExporter(export_dir, eval_metric))
+    
+    train_spec = tf.estimator.TrainSpec(input_fn=train_input_fn, max_steps=max_steps, hooks=hooks)
+    
+    # No throttling, so that every checkpoint gets evaluated as soon as it is saved.
+    eval_spec = tf.estimator.EvalSpec(input_fn=eval_input_fn, steps=None, exporters=exporters, start_delay_secs=0, throttle_secs=0)
+    tf.estimator.train_and_evaluate(estimator, train_spec, eval_spec)
+
 def decode_predicts(predicts,
                     sent_label_list,
                     max_seq_length,
@@ -628,6 +2449,46 @@ def write_to_text(data_list,
         for data in data_list:
             file.write("{0}\n".format(data))
 
+def get_worker_cluster():
+    """Reads the data-parallel workers from TF_CONFIG, e.g.
+    {"cluster": {"worker": ["host1:2222", "host2:2222"]}, "task": {"type": "worker", "index": 0}}.
+    
+    Returns the cluster spec and the index of this worker. Every worker runs its own Estimator and only talks to
+    the others through collective all-reduce, so TF_CONFIG is taken out of the environment before RunConfig would
+    read it as a chief/ps cluster.
+    """
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    cluster = tf_config.get("cluster", {})
+    task = tf_config.get("task", {})
+    if "worker" not in cluster or task.get("type") != "worker":
+        raise ValueError("Collective all-reduce requires TF_CONFIG with a 'worker' cluster and a 'worker' task")
+    
+    del os.environ["TF_CONFIG"]
+    return tf.train.ClusterSpec({ "worker": cluster["worker"] }), int(task.get("index", 0))
+
+def get_xla_session_config(session_config=None):
+    """Turns on XLA auto-clustering in a session config, so that clusters of ops (e.g. the many small elementwise ops
+    of every BERT layer) are compiled and fused. TF only auto-clusters CPU ops with `--tf_xla_cpu_global_jit` in
+    TF_XLA_FLAGS, which is added here before the first session starts."""
+    xla_flags = os.environ.get("TF_XLA_FLAGS", "")
+    if "--tf_xla_cpu_global_jit" not in xla_flags:
+        os.environ["TF_XLA_FLAGS"] = (xla_flags + " --tf_xla_cpu_global_jit").strip()
+    
+    if session_config is None:
+        session_config = tf.ConfigProto(allow_soft_placement=True)
+    
+    session_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return session_config
+
+def get_collective_session_config(worker_index):
+    """Creates the session config of a worker taking part in collective all-reduce."""
+    session_config = tf.ConfigProto(allow_soft_placement=True)
+    session_config.experimental.collective_group_leader = "/job:worker/replica:0/task:0"
+    
+    # Each worker places its whole graph on its own devices; gradients are exchanged by the collective ops only.
+    session_config.device_filters.append("/job:worker/task:{0}".format(worker_index))
+    return session_config
+
 def main(_):
     tf.logging.set_verbosity(tf.logging.INFO)
     
@@ -639,6 +2500,61 @@ def main(_):
         raise ValueError("Cannot use sequence length %d because the BERT model was only trained up to sequence length %d" %
             (FLAGS.max_seq_length, bert_config.max_position_embeddings))
     
+    if FLAGS.freeze_layers > bert_config.num_hidden_layers:
+        raise ValueError("Cannot freeze %d layers because the BERT model only has %d layers" %
+            (FLAGS.freeze_layers, bert_config.num_hidden_layers))
+    
+    if FLAGS.stream_train_data and FLAGS.data_format != "jsonl":
+        raise ValueError("Streaming train data requires `data_format` to be 'jsonl'")
+    
+    if FLAGS.stream_train_data and FLAGS.use_tpu:
+        raise ValueError("Streaming train data is not supported on TPU")
+    
+    if FLAGS.do_bucketing and FLAGS.use_tpu:
+        raise ValueError("Bucketing produces batches of varying shape, which is not supported on TPU")
+    
+    if FLAGS.memmap_feature_dir and FLAGS.use_tpu:
+        raise ValueError("Memory-mapped features are read through tf.py_func, which is not supported on TPU")
+    
+    if FLAGS.do_packing and (FLAGS.do_bucketing or FLAGS.stream_train_data):
+        raise ValueError("Packing cannot be combined with bucketing or streaming train data")
+    
+    if FLAGS.do_train_and_eval and (not FLAGS.do_train or FLAGS.use_collective_all_reduce):
+        raise ValueError("Train-and-evaluate requires `do_train` and cannot be combined with collective all-reduce")
+    
+    if FLAGS.use_xla and FLAGS.use_tpu:
+        raise ValueError("`use_xla` is for CPU/GPU, TPU always compiles with XLA")
+    
+    if FLAGS.profile_steps and (len(FLAGS.profile_steps.split(":")) != 2 or FLAGS.use_tpu):
+        raise ValueError("`profile_steps` must be a `<start>:<end>` step window, e.g. '100:110', and is not supported on TPU")
+    
+    if FLAGS.use_collective_all_reduce and FLAGS.use_tpu:
+        raise ValueError("Collective all-reduce is for data-parallel CPU/GPU workers, use `num_tpu_cores` on TPU")
+    
+    if FLAGS.encoder_output_dir and (FLAGS.use_tpu or FLAGS.stream_train_data or FLAGS.do_packing or FLAGS.use_collective_all_reduce):
+        raise ValueError("Training heads from stored encoder outputs cannot be combined with TPU, streaming train data, packing or collective all-reduce")
+    
+    num_workers = 1
+    worker_index = 0
+    master = FLAGS.master
+    model_dir = FLAGS.output_dir
+    session_config = None
+    if FLAGS.use_collective_all_reduce:
+        cluster_spec, worker_index = get_worker_cluster()
+        num_workers = cluster_spec.num_tasks("worker")
+        session_config = get_collective_session_config(worker_index)
+        server = tf.train.Server(cluster_spec, job_name="worker", task_index=worker_index, config=session_config)
+        master = server.target
+        if worker_index > 0:
+            # Only the first worker writes checkpoints and summaries to `output_dir`.
+            model_dir = os.path.join(FLAGS.output_dir, "worker-{0}".format(worker_index))
+    
+    if FLAGS.gradient_accumulation_steps < 1 or FLAGS.train_batch_size % (FLAGS.gradient_accumulation_steps * num_workers) != 0:
+        raise ValueError("`train_batch_size` (%d) must be a multiple of `gradient_accumulation_steps` (%d) times the number of workers (%d)" %
+            (FLAGS.train_batch_size, FLAGS.gradient_accumulation_steps, num_workers))
+    
+    micro_batch_size = FLAGS.train_batch_size // (FLAGS.gradient_accumulation_steps * num_workers)
+    
     tf.gfile.MakeDirs(FLAGS.output_dir)
     
     tokenization.validate_case_matches_checkpoint(FLAGS.do_lower_case, FLAGS.init_checkpoint)
@@ -646,15 +2562,69 @@ def main(_):
     
     data_dir = FLAGS.data_dir
     task_name = FLAGS.task_name.lower()
-    processor = ClassificationProcessor(data_dir, task_name)
+    processor = ClassificationProcessor(data_dir, task_name, data_format=FLAGS.data_format)
     sent_label_list = processor.get_sent_labels()
     
-    train_examples = None
+    feature_config = {
+        "task_type": "classifier",
+        "do_lower_case": FLAGS.do_lower_case,
+        "max_seq_length": FLAGS.max_seq_length
+    }
+    
+    feature_cache = None
+    if FLAGS.feature_cache_dir:
+        feature_cache = FeatureCache(
+            cache_dir=FLAGS.feature_cache_dir,
+            task_name=task_name,
+            resource_paths=[FLAGS.vocab_file] + processor.get_label_paths(),
+            config=feature_config)
+    
+    feature_store = None
+    if FLAGS.memmap_feature_dir:
+        feature_store = MemmapFeatureStore(
+            feature_dir=FLAGS.memmap_feature_dir,
+            task_name=task_name,
+            resource_paths=[FLAGS.vocab_file] + processor.get_label_paths(),
+            config=feature_config)
+    
+    encoder_output_store = None
+    if FLAGS.encoder_output_dir:
+        encoder_output_store = EncoderOutputStore(
+            output_dir=FLAGS.encoder_output_dir,
+            task_name=task_name,
+            config=dict(feature_config,
+                init_checkpoint=FLAGS.init_checkpoint,
+                bert_config_file=FLAGS.bert_config_file,
+                encoder_output_float16=FLAGS.encoder_output_float16))
+    
+    train_features = None
+    num_train_examples = None
     num_train_steps = None
     num_warmup_steps = None
     if FLAGS.do_train:
-        train_examples = processor.get_train_examples()
-        num_train_steps = int(len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+        if FLAGS.stream_train_data:
+            num_train_examples = processor.get_num_examples("train")
+        else:
+            train_features = get_features(
+                processor=processor,
+                data_type="train",
+                sent_label_list=sent_label_list,
+                max_seq_length=FLAGS.max_seq_length,
+                tokenizer=tokenizer,
+                num_workers=FLAGS.num_preprocess_workers,
+                feature_cache=feature_cache,
+                feature_store=feature_store)
+            num_train_examples = len(train_features)
+            if FLAGS.do_packing:
+                # Each worker packs its own shard of the train set.
+                if num_workers > 1:
+                    train_features = train_features.shard(num_workers, worker_index)
+                
+                train_features = pack_features(train_features, FLAGS.max_seq_length, FLAGS.max_examples_per_pack)
+        
+        # A packed row holds several examples, so an epoch takes as many steps as there are rows.
+        num_train_rows = len(train_features) * num_workers if FLAGS.do_packing else num_train_examples
+        num_train_steps = int(num_train_rows / FLAGS.train_batch_size * FLAGS.num_train_epochs)
         num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
     
     tpu_cluster_resolver = None
@@ -662,12 +2632,18 @@ def main(_):
         tpu_cluster_resolver = tf.contrib.cluster_resolver.TPUClusterResolver(
             FLAGS.tpu_name, zone=FLAGS.tpu_zone, project=FLAGS.gcp_project)
     
+    if FLAGS.use_xla:
+        session_config = get_xla_session_config(session_config)
+    
     is_per_host = tf.contrib.tpu.InputPipelineConfig.PER_HOST_V2
     run_config = tf.contrib.tpu.RunConfig(
         cluster=tpu_cluster_resolver,
-        master=FLAGS.master,
-        model_dir=FLAGS.output_dir,
+        master=master,
+        model_dir=model_dir,
         save_checkpoints_steps=FLAGS.save_checkpoints_steps,
+        session_config=session_config,
+        # Workers start from identical weights only if they initialize the task layers with the same seed.
+        tf_random_seed=FLAGS.random_seed if FLAGS.use_collective_all_reduce else None,
         tpu_config=tf.contrib.tpu.TPUConfig(
             iterations_per_loop=FLAGS.iterations_per_loop,
             num_shards=FLAGS.num_tpu_cores,
@@ -680,7 +2656,12 @@ def main(_):
         learning_rate=FLAGS.learning_rate,
         num_train_steps=num_train_steps,
         num_warmup_steps=num_warmup_steps,
-        use_tpu=FLAGS.use_tpu)
+        use_tpu=FLAGS.use_tpu,
+        gradient_accumulation_steps=FLAGS.gradient_accumulation_steps,
+        num_workers=num_workers,
+        freeze_embeddings=FLAGS.freeze_embeddings,
+        freeze_layers=FLAGS.freeze_layers,
+        use_xla=FLAGS.use_xla)
     
     # If TPU is not available, this will fall back to normal Estimator on CPU or GPU.
     estimator = tf.contrib.tpu.TPUEstimator(
@@ -688,74 +2669,181 @@ def main(_):
         model_fn=model_fn,
         config=run_config,
         export_to_tpu=FLAGS.use_tpu,
-        train_batch_size=FLAGS.train_batch_size,
+        train_batch_size=micro_batch_size,
         eval_batch_size=FLAGS.eval_batch_size,
         predict_batch_size=FLAGS.predict_batch_size)
     
+    encoder_estimator = None
+    if FLAGS.encoder_output_dir:
+        # Only predicts encoder outputs, initialized from `init_checkpoint` since its model dir never holds a checkpoint.
+        encoder_estimator = tf.contrib.tpu.TPUEstimator(
+            use_tpu=False,
+            model_fn=encoder_model_fn_builder(bert_config, FLAGS.init_checkpoint),
+            config=tf.contrib.tpu.RunConfig(model_dir=os.path.join(FLAGS.encoder_output_dir, "encoder")),
+            predict_batch_size=FLAGS.predict_batch_size)
+    
+    eval_features = None
+    eval_input_fn = None
+    if (FLAGS.do_eval or FLAGS.do_train_and_eval) and worker_index == 0:
+        eval_features = get_features(
+            processor=processor,
+            data_type="dev",
+            sent_label_list=sent_label_list,
+            max_seq_length=FLAGS.max_seq_length,
+            tokenizer=tokenizer,
+            num_workers=FLAGS.num_preprocess_workers,
+            feature_cache=feature_cache,
+            feature_store=feature_store)
+        
+        if FLAGS.encoder_output_dir:
+            eval_input_fn = get_head_input_fn(
+                features=eval_features,
+                data_type="dev",
+                data_path=processor.get_data_path("dev"),
+                is_training=False,
+                drop_remainder=False,
+                encoder_estimator=encoder_estimator,
+                encoder_output_store=encoder_output_store,
+                hidden_size=bert_config.hidden_size)
+        else:
+            eval_input_fn = get_input_fn(
+                features=eval_features,
+                data_type="dev",
+                is_training=False,
+                drop_remainder=False)
+        
+        if FLAGS.use_xla:
+            eval_input_fn = pad_input_fn_builder(eval_input_fn)
+    
     if FLAGS.do_train:
         tf.logging.info("***** Run training *****")
-        tf.logging.info("  Num examples = %d", len(train_examples))
+        tf.logging.info("  Num examples = %d", num_train_examples)
+        if FLAGS.do_packing:
+            tf.logging.info("  Num packed rows = %d", num_train_rows)
         tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
         tf.logging.info("  Num steps = %d", num_train_steps)
+        if FLAGS.gradient_accumulation_steps > 1 or num_workers > 1:
+            tf.logging.info("  Num workers = %d", num_workers)
+            tf.logging.info("  Micro-batch size = %d", micro_batch_size)
+            tf.logging.info("  Num micro-batch steps = %d", num_train_steps * FLAGS.gradient_accumulation_steps)
         
-        train_features = convert_examples_to_features(
-            examples=train_examples,
-            sent_label_list=sent_label_list,
-            max_seq_length=FLAGS.max_seq_length,
-            tokenizer=tokenizer)
-
-        train_input_fn = input_fn_builder(
-            features=train_features,
-            seq_length=FLAGS.max_seq_length,
-            is_training=True,
-            drop_remainder=True)
+        if FLAGS.stream_train_data:
+            train_input_fn = generator_input_fn_builder(
+                example_fn=processor.iter_train_examples,
+                sent_label_list=sent_label_list,
+                seq_length=FLAGS.max_seq_length,
+                tokenizer=tokenizer,
+                is_training=True,
+                drop_remainder=True,
+                do_bucketing=FLAGS.do_bucketing,
+                bucket_boundaries=get_bucket_boundaries(FLAGS.bucket_boundaries, FLAGS.max_seq_length),
+                shuffle_buffer_size=FLAGS.shuffle_buffer_size if FLAGS.shuffle_buffer_size > 0 else 10000,
+                prefetch_buffer_size=FLAGS.prefetch_buffer_size,
+                num_shards=num_workers,
+                shard_index=worker_index)
+        elif FLAGS.do_packing:
+            train_input_fn = get_packed_input_fn(
+                features=train_features,
+                data_type="train-packed" if num_workers <= 1 else "train-packed-{0}".format(worker_index),
+                is_training=True,
+                drop_remainder=True)
+        elif FLAGS.encoder_output_dir:
+            train_input_fn = get_head_input_fn(
+                features=train_features,
+                data_type="train",
+                data_path=processor.get_data_path("train"),
+                is_training=True,
+                drop_remainder=True,
+                encoder_estimator=encoder_estimator,
+                encoder_output_store=encoder_output_store,
+                hidden_size=bert_config.hidden_size)
+        else:
+            train_input_fn = get_input_fn(
+                features=train_features,
+                data_type="train",
+                is_training=True,
+                drop_remainder=True,
+                num_shards=num_workers,
+                shard_index=worker_index)
         
-        estimator.train(input_fn=train_input_fn, max_steps=num_train_steps)
+        train_hooks = get_profile_hooks(FLAGS.profile_steps, os.path.join(model_dir, "profile", "train"))
+        if FLAGS.train_stats_steps > 0 and not FLAGS.use_tpu:
+            train_hooks.append(TrainingStatsHook(model_dir, os.path.join(model_dir, "train_stats.json"), FLAGS.train_stats_steps))
+        
+        if FLAGS.do_train_and_eval:
+            train_and_evaluate(
+                estimator=estimator,
+                train_input_fn=train_input_fn,
+                eval_input_fn=eval_input_fn,
+                max_steps=num_train_steps * FLAGS.gradient_accumulation_steps,
+                save_checkpoints_steps=FLAGS.save_checkpoints_steps,
+                eval_metric=FLAGS.eval_metric,
+                early_stopping_patience=FLAGS.early_stopping_patience,
+                export_dir=FLAGS.export_dir,
+                train_hooks=train_hooks)
+        else:
+            estimator.train(input_fn=train_input_fn, max_steps=num_train_steps * FLAGS.gradient_accumulation_steps, hooks=train_hooks)
+    
+    if worker_index > 0:
+        tf.logging.info("Worker %d is done, evaluation, prediction and exporting only run on worker 0", worker_index)
+        return
     
     if FLAGS.do_eval:
-        eval_examples = processor.get_dev_examples()
         tf.logging.info("***** Run evaluation *****")
-        tf.logging.info("  Num examples = %d", len(eval_examples))
+        tf.logging.info("  Num examples = %d", len(eval_features))
         tf.logging.info("  Batch size = %d", FLAGS.eval_batch_size)
         
-        eval_features = convert_examples_to_features(
-            examples=eval_examples,
-            sent_label_list=sent_label_list,
-            max_seq_length=FLAGS.max_seq_length,
-            tokenizer=tokenizer)
-
-        eval_input_fn = input_fn_builder(
-            features=eval_features,
-            seq_length=FLAGS.max_seq_length,
-            is_training=False,
-            drop_remainder=False)
-        
         result = estimator.evaluate(input_fn=eval_input_fn)
         
         sent_accuracy = result["sent_accuracy"]
         
         tf.logging.info("***** Evaluation result *****")
         tf.logging.info("  Accuracy (sent-level) = %s", str(sent_accuracy))
+        
+        # Read back by tool/sweep.py to aggregate runs.
+        write_to_json(dict([(name, float(value)) for (name, value) in result.items()]), os.path.join(FLAGS.output_dir, "eval_result.json"))
     
     if FLAGS.do_predict:
-        predict_examples = processor.get_test_examples()
+        predict_features = get_features(
+            processor=processor,
+            data_type="test",
+            sent_label_list=sent_label_list,
+            max_seq_length=FLAGS.max_seq_length,
+            tokenizer=tokenizer,
+            num_workers=FLAGS.num_preprocess_workers,
+            feature_cache=feature_cache,
+            feature_store=feature_store)
+        
         tf.logging.info("***** Run prediction *****")
-        tf.logging.info("  Num examples = %d", len(predict_examples))
+        tf.logging.info("  Num examples = %d", len(predict_features))
         tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
         
-        predict_features = convert_examples_to_features(
-            examples=predict_examples,
-            sent_label_list=sent_label_list,
-            max_seq_length=FLAGS.max_seq_length,
-            tokenizer=tokenizer)
-
-        predict_input_fn = input_fn_builder(
-            features=predict_features,
-            seq_length=FLAGS.max_seq_length,
-            is_training=False,
-            drop_remainder=False)
+        if FLAGS.encoder_output_dir:
+            predict_input_fn = get_head_input_fn(
+                features=predict_features,
+                data_type="test",
+                data_path=processor.get_data_path("test"),
+                is_training=False,
+                drop_remainder=False,
+                encoder_estimator=encoder_estimator,
+                encoder_output_store=encoder_output_store,
+                hidden_size=bert_config.hidden_size)
+        else:
+            predict_input_fn = get_input_fn(
+                features=predict_features,
+                data_type="test",
+                is_training=False,
+                drop_remainder=False)
+        
+        if FLAGS.use_xla:
+            predict_input_fn = pad_input_fn_builder(predict_input_fn)
         
-        result = estimator.predict(input_fn=predict_input_fn)
+        result = estimator.predict(input_fn=predict_input_fn,
+            hooks=get_profile_hooks(FLAGS.profile_steps, os.path.join(FLAGS.output_dir, "profile", "predict")))
+        if FLAGS.do_bucketing and not FLAGS.encoder_output_dir:
+            # Bucketing batches examples out of order, so sort the predictions back before matching them with features.
+            # Examples padding the last batch have `example_index` -1 and are dropped.
+            result = sorted([predict for predict in result if predict["example_index"] >= 0], key=lambda predict: predict["example_index"])
         
         predicts = [{
             "input_ids": feature.input_ids,
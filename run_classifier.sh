@@ -75,6 +75,7 @@ CUDA_VISIBLE_DEVICES=${GPUDEVICE} python run_classifier.py \
 --data_dir=${DATADIR}/ \
 --output_dir=${OUTPUTDIR}/debug \
 --export_dir=${OUTPUTDIR}/export \
+--feature_cache_dir=${OUTPUTDIR}/cache \
 --max_seq_length=${MAXLEN} \
 --train_batch_size=${BATCHSIZE} \
 --learning_rate=${LEARNINGRATE} \
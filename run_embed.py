@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import contextlib
 import csv
 import os
 
@@ -29,6 +30,7 @@ flags.DEFINE_integer(
     "The maximum total input sequence length after WordPiece tokenization. "
     "Sequences longer than this will be truncated, and sequences shorter than this will be padded.")
 
+flags.DEFINE_bool("use_xla", False, "Whether to compile the model with XLA, auto-clustering the graphs run here and marking the model ops of the exported SavedModel for compilation wherever it is served. Not used on TPU, which always compiles with XLA.")
 flags.DEFINE_bool("use_tpu", False, "Whether to use TPU or GPU/CPU.")
 flags.DEFINE_integer("num_tpu_cores", 8,"Only used if `use_tpu` is True. Total number of TPU cores to use.")
 flags.DEFINE_string("master", None, "[Optional] TensorFlow master URL.")
@@ -364,11 +366,20 @@ def create_model(bert_config,
 
     return output_result
 
+def get_jit_scope(use_xla):
+    """Gets a scope that marks the ops created in it for XLA compilation if `use_xla`. The marks are part of the graph,
+    so a SavedModel exported from it is compiled wherever it is served. Otherwise the scope does nothing."""
+    if use_xla:
+        return tf.contrib.compiler.jit.experimental_jit_scope()
+    
+    return contextlib.ExitStack()
+
 def model_fn_builder(bert_config,
                      init_checkpoint,
                      use_tpu,
                      use_one_hot_embeddings,
-                     model_type):
+                     model_type,
+                     use_xla=False):
     """Returns `model_fn` closure for TPUEstimator."""
     def model_fn(features,
                  labels,
@@ -383,7 +394,8 @@ def model_fn_builder(bert_config,
         input_mask = features["input_mask"]
         segment_ids = features["segment_ids"]
         
-        embeddings = create_model(bert_config, input_ids, input_mask, segment_ids, use_one_hot_embeddings, model_type)
+        with get_jit_scope(use_xla):
+            embeddings = create_model(bert_config, input_ids, input_mask, segment_ids, use_one_hot_embeddings, model_type)
         
         tvars = tf.trainable_variables()
         initialized_variable_names = {}
@@ -439,6 +451,20 @@ def serving_input_fn():
         
         return tf.estimator.export.build_raw_serving_input_receiver_fn(features)()
 
+def get_xla_session_config(session_config=None):
+    """Turns on XLA auto-clustering in a session config, so that clusters of ops (e.g. the many small elementwise ops
+    of every BERT layer) are compiled and fused. TF only auto-clusters CPU ops with `--tf_xla_cpu_global_jit` in
+    TF_XLA_FLAGS, which is added here before the first session starts."""
+    xla_flags = os.environ.get("TF_XLA_FLAGS", "")
+    if "--tf_xla_cpu_global_jit" not in xla_flags:
+        os.environ["TF_XLA_FLAGS"] = (xla_flags + " --tf_xla_cpu_global_jit").strip()
+    
+    if session_config is None:
+        session_config = tf.ConfigProto(allow_soft_placement=True)
+    
+    session_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return session_config
+
 def main(_):
     tf.logging.set_verbosity(tf.logging.INFO)
     
@@ -448,6 +474,9 @@ def main(_):
         raise ValueError("Cannot use sequence length %d because the BERT model was only trained up to sequence length %d" %
             (FLAGS.max_seq_length, bert_config.max_position_embeddings))
     
+    if FLAGS.use_xla and FLAGS.use_tpu:
+        raise ValueError("`use_xla` is for CPU/GPU, TPU always compiles with XLA")
+    
     tf.gfile.MakeDirs(FLAGS.output_dir)
     
     tokenization.validate_case_matches_checkpoint(FLAGS.do_lower_case, FLAGS.init_checkpoint)
@@ -458,12 +487,15 @@ def main(_):
         tpu_cluster_resolver = tf.contrib.cluster_resolver.TPUClusterResolver(
             FLAGS.tpu_name, zone=FLAGS.tpu_zone, project=FLAGS.gcp_project)
     
+    session_config = get_xla_session_config() if FLAGS.use_xla else None
+    
     is_per_host = tf.contrib.tpu.InputPipelineConfig.PER_HOST_V2
     run_config = tf.contrib.tpu.RunConfig(
         cluster=tpu_cluster_resolver,
         master=FLAGS.master,
         model_dir=FLAGS.output_dir,
         save_checkpoints_steps=1000,
+        session_config=session_config,
         tpu_config=tf.contrib.tpu.TPUConfig(
             iterations_per_loop=1000,
             num_shards=FLAGS.num_tpu_cores,
@@ -474,7 +506,8 @@ def main(_):
         init_checkpoint=FLAGS.init_checkpoint,
         use_tpu=FLAGS.use_tpu,
         use_one_hot_embeddings=FLAGS.use_tpu,
-        model_type=FLAGS.model_type)
+        model_type=FLAGS.model_type,
+        use_xla=FLAGS.use_xla)
     
     # If TPU is not available, this will fall back to normal Estimator on CPU or GPU.
     estimator = tf.contrib.tpu.TPUEstimator(
@@ -0,0 +1,88 @@
+import argparse
+import importlib
+import os.path
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bert import tokenization
+
+def add_arguments(parser):
+    parser.add_argument("--task_type", help="task type, one of ner, nlu and classifier", required=True)
+    parser.add_argument("--task_name", help="task name", required=True)
+    parser.add_argument("--data_dir", help="input data directory", required=True)
+    parser.add_argument("--data_format", help="data format, json or jsonl", default="json")
+    parser.add_argument("--vocab_file", help="path to vocab file", required=True)
+    parser.add_argument("--do_lower_case", help="whether to lower case the input text", type=lambda value: value.lower() == "true", default=True)
+    parser.add_argument("--max_seq_length", help="maximum sequence length", type=int, default=128)
+    parser.add_argument("--doc_stride", help="ner only, stride of the sliding windows long sentences are split into, 0 to truncate them", type=int, default=0)
+    parser.add_argument("--num_workers", help="number of conversion worker processes", type=int, default=1)
+    parser.add_argument("--output_dir", help="output feature directory, to be passed as --memmap_feature_dir", required=True)
+
+def build_memmap(task_type,
+                 task_name,
+                 data_dir,
+                 data_format,
+                 vocab_file,
+                 do_lower_case,
+                 max_seq_length,
+                 doc_stride,
+                 num_workers,
+                 output_dir):
+    run_module = importlib.import_module("run_{0}".format(task_type))
+    task_name = task_name.lower()
+    
+    if task_type == "ner":
+        processor = run_module.NerProcessor(data_dir, task_name, data_format=data_format)
+        feature_args = { "label_list": processor.get_labels() }
+    elif task_type == "nlu":
+        processor = run_module.NluProcessor(data_dir, task_name, data_format=data_format)
+        feature_args = { "token_label_list": processor.get_token_labels(), "sent_label_list": processor.get_sent_labels() }
+    elif task_type == "classifier":
+        processor = run_module.ClassificationProcessor(data_dir, task_name, data_format=data_format)
+        feature_args = { "sent_label_list": processor.get_sent_labels() }
+    else:
+        raise ValueError("unsupported task type {0}".format(task_type))
+    
+    tokenizer = tokenization.FullTokenizer(vocab_file=vocab_file, do_lower_case=do_lower_case)
+    
+    # Must match the config run_*.py builds from its flags, otherwise the features are rebuilt at run time.
+    feature_config = {
+        "task_type": task_type,
+        "do_lower_case": do_lower_case,
+        "max_seq_length": max_seq_length
+    }
+    
+    if task_type == "ner":
+        feature_config["doc_stride"] = doc_stride
+        feature_args["doc_stride"] = doc_stride
+    
+    feature_store = run_module.MemmapFeatureStore(
+        feature_dir=output_dir,
+        task_name=task_name,
+        resource_paths=[vocab_file] + processor.get_label_paths(),
+        config=feature_config)
+    
+    for data_type in ["train", "dev", "test"]:
+        data_path = processor.get_data_path(data_type)
+        if not os.path.exists(data_path):
+            print("Skipping {0}, data path {1} not found".format(data_type, data_path))
+            continue
+        
+        features = run_module.get_features(
+            processor=processor,
+            data_type=data_type,
+            max_seq_length=max_seq_length,
+            tokenizer=tokenizer,
+            num_workers=num_workers,
+            feature_store=feature_store,
+            **feature_args)
+        
+        print("Built {0} {1} features in {2}".format(len(features), data_type, output_dir))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    build_memmap(args.task_type, args.task_name, args.data_dir, args.data_format, args.vocab_file,
+        args.do_lower_case, args.max_seq_length, args.doc_stride, args.num_workers, args.output_dir)
@@ -0,0 +1,177 @@
+import argparse
+import collections
+import json
+import os.path
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bert import tokenization
+
+def add_arguments(parser):
+    parser.add_argument("--task_type", help="task type, one of ner, nlu and classifier", required=True)
+    parser.add_argument("--input_file", help="path to train json or jsonl file", required=True)
+    parser.add_argument("--data_format", help="data format, json or jsonl", default="json")
+    parser.add_argument("--vocab_file", help="path to vocab file", required=True)
+    parser.add_argument("--do_lower_case", help="whether to lower case the input text", type=lambda value: value.lower() == "true", default=True)
+    parser.add_argument("--candidate_lengths", help="comma-separated max_seq_length candidates", default="32,48,64,96,128,192,256,384,512")
+    parser.add_argument("--max_truncation_rate", help="highest fraction of truncated examples the recommended max length may have", type=float, default=0.001)
+    parser.add_argument("--num_buckets", help="number of bucket boundaries to recommend", type=int, default=4)
+    parser.add_argument("--hidden_size", help="hidden size of the model, weighs attention against dense layers in the cost model", type=int, default=768)
+
+def read_data(input_file,
+              data_format):
+    with open(input_file, "r") as file:
+        if data_format == "jsonl":
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for data in json.load(file):
+                yield data
+
+def get_seq_lengths(data_list,
+                    task_type,
+                    tokenizer):
+    """Gets the wordpiece length of every example, including [CLS] and [SEP], the way run_*.py tokenizes it,
+    together with the label frequencies."""
+    word_lengths = {}
+    seq_lengths = []
+    label_counters = collections.OrderedDict()
+    for data in data_list:
+        text = tokenization.convert_to_unicode(data["text"])
+        if task_type == "classifier":
+            num_tokens = len(tokenizer.tokenize(text))
+        else:
+            # NER and NLU tokenize word by word, so cache the wordpiece count of each word.
+            num_tokens = 0
+            for word in text.split(" "):
+                if word not in word_lengths:
+                    word_lengths[word] = len(tokenizer.tokenize(word))
+                num_tokens += word_lengths[word]
+        
+        seq_lengths.append(num_tokens + 2)
+        
+        for label_key in ["label", "token_label", "sent_label"]:
+            if label_key not in data:
+                continue
+            
+            labels = data[label_key].split(" ") if label_key != "sent_label" else [data[label_key]]
+            label_counters.setdefault(label_key, collections.Counter()).update(labels)
+    
+    return np.array(seq_lengths, dtype=np.int64), label_counters
+
+def get_cost(seq_lengths,
+             hidden_size):
+    """Relative FLOPs of running the encoder on sequences of the given lengths.
+    
+    Per layer the dense projections cost about 24 * S * H^2 and the attention about 4 * S^2 * H,
+    so the cost of a length S sequence is proportional to S * (6 * H + S).
+    """
+    seq_lengths = np.asarray(seq_lengths, dtype=np.float64)
+    return seq_lengths * (6.0 * hidden_size + seq_lengths)
+
+def get_bucket_boundaries(seq_lengths,
+                          max_seq_length,
+                          num_buckets,
+                          hidden_size):
+    """Picks bucket boundaries (multiples of 8, the last being `max_seq_length`) that minimize the total padded cost,
+    with every example padded up to the smallest boundary it fits into."""
+    seq_lengths = np.minimum(seq_lengths, max_seq_length)
+    candidates = sorted(set(list(range(8, max_seq_length, 8)) + [max_seq_length]))
+    counts = np.array([np.sum((seq_lengths > low) & (seq_lengths <= high))
+        for low, high in zip([0] + candidates[:-1], candidates)], dtype=np.float64)
+    costs = get_cost(candidates, hidden_size)
+    
+    # best[k][j] is the lowest cost of the examples up to candidates[j] with k boundaries, the last one at candidates[j].
+    num_candidates = len(candidates)
+    best = np.full([num_buckets + 1, num_candidates], np.inf)
+    previous = np.full([num_buckets + 1, num_candidates], -1, dtype=np.int64)
+    for j in range(num_candidates):
+        best[1][j] = np.sum(counts[:j + 1]) * costs[j]
+    
+    for k in range(2, num_buckets + 1):
+        for j in range(num_candidates):
+            for i in range(j):
+                cost = best[k - 1][i] + np.sum(counts[i + 1:j + 1]) * costs[j]
+                if cost < best[k][j]:
+                    best[k][j] = cost
+                    previous[k][j] = i
+    
+    num_boundaries = min(num_buckets, num_candidates)
+    boundaries = []
+    j = num_candidates - 1
+    for k in range(num_boundaries, 0, -1):
+        boundaries.append(candidates[j])
+        j = previous[k][j]
+        if j < 0:
+            break
+    
+    return sorted(boundaries)
+
+def get_padded_cost(seq_lengths,
+                    boundaries,
+                    hidden_size):
+    """Total cost of padding every example up to the smallest boundary it fits into, truncating at the last one."""
+    boundaries = np.array(boundaries)
+    padded_lengths = boundaries[np.minimum(np.searchsorted(boundaries, seq_lengths), len(boundaries) - 1)]
+    return np.sum(get_cost(padded_lengths, hidden_size))
+
+def corpus_stats(task_type,
+                 input_file,
+                 data_format,
+                 vocab_file,
+                 do_lower_case,
+                 candidate_lengths,
+                 max_truncation_rate,
+                 num_buckets,
+                 hidden_size):
+    tokenizer = tokenization.FullTokenizer(vocab_file=vocab_file, do_lower_case=do_lower_case)
+    seq_lengths, label_counters = get_seq_lengths(read_data(input_file, data_format), task_type, tokenizer)
+    if len(seq_lengths) == 0:
+        raise ValueError("no examples found in {0}".format(input_file))
+    
+    print("Examples: {0}".format(len(seq_lengths)))
+    print("Wordpiece length (with [CLS] and [SEP]):")
+    print("  mean {0:.1f}".format(np.mean(seq_lengths)))
+    for percentile in [50, 90, 95, 99, 99.9]:
+        print("  p{0} {1:.0f}".format(percentile, np.percentile(seq_lengths, percentile)))
+    print("  max {0}".format(np.max(seq_lengths)))
+    
+    unpadded_cost = np.sum(get_cost(seq_lengths, hidden_size))
+    candidate_lengths = sorted([int(length) for length in candidate_lengths.split(",") if length.strip()])
+    print("")
+    print("{0:>14} {1:>12} {2:>14} {3:>14}".format("max_seq_length", "truncated", "padding waste", "padded FLOPs"))
+    for max_seq_length in candidate_lengths:
+        truncation_rate = np.mean(seq_lengths > max_seq_length)
+        padding_waste = 1.0 - np.sum(np.minimum(seq_lengths, max_seq_length)) / float(len(seq_lengths) * max_seq_length)
+        padded_cost = get_padded_cost(seq_lengths, [max_seq_length], hidden_size)
+        print("{0:>14} {1:>11.2%} {2:>13.2%} {3:>13.2f}x".format(max_seq_length, truncation_rate, padding_waste, padded_cost / unpadded_cost))
+    
+    for label_key, label_counter in label_counters.items():
+        num_labels = float(sum(label_counter.values()))
+        print("")
+        print("Label frequency ({0}):".format(label_key))
+        for label, count in label_counter.most_common():
+            print("  {0:<24} {1:>10} {2:>8.2%}".format(label, count, count / num_labels))
+    
+    fitting_lengths = [length for length in candidate_lengths if np.mean(seq_lengths > length) <= max_truncation_rate]
+    max_seq_length = fitting_lengths[0] if fitting_lengths else candidate_lengths[-1]
+    boundaries = get_bucket_boundaries(seq_lengths, max_seq_length, num_buckets, hidden_size)
+    
+    print("")
+    print("Recommended max_seq_length {0} (truncates {1:.2%}, padded FLOPs {2:.2f}x)".format(max_seq_length,
+        np.mean(seq_lengths > max_seq_length), get_padded_cost(seq_lengths, [max_seq_length], hidden_size) / unpadded_cost))
+    print("Recommended bucket boundaries {0} (padded FLOPs {1:.2f}x)".format(",".join([str(boundary) for boundary in boundaries]),
+        get_padded_cost(seq_lengths, boundaries, hidden_size) / unpadded_cost))
+    print("  --max_seq_length={0} --do_bucketing=true --bucket_boundaries={1}".format(max_seq_length,
+        ",".join([str(boundary) for boundary in boundaries])))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    corpus_stats(args.task_type, args.input_file, args.data_format, args.vocab_file, args.do_lower_case,
+        args.candidate_lengths, args.max_truncation_rate, args.num_buckets, args.hidden_size)
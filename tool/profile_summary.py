@@ -0,0 +1,120 @@
+import argparse
+import collections
+import glob
+import json
+import os.path
+import re
+
+# Checked in order, the first scope found in an op name decides its component.
+COMPONENT_SCOPES = [
+    ("/adapter/", "adapters"),
+    ("/attention/self/", "attention"),
+    ("/attention/output/", "attention output"),
+    ("/intermediate/", "intermediate"),
+    ("bert/encoder/", "layer output"),
+    ("bert/embeddings/", "embeddings"),
+    ("bert/pooler/", "pooler")
+]
+
+HEAD_SCOPES = ["ner/", "token/", "sent/", "loss/", "token_loss/", "sent_loss/"]
+
+MATMUL_OPS = ["MatMul", "BatchMatMul", "BatchMatMulV2", "BiasAdd", "Tensordot"]
+
+def add_arguments(parser):
+    parser.add_argument("--profile_dir", help="directory with the timeline-<step>.json files of a --profile_steps run, e.g. output/ner/conll2003/profile/train", required=True)
+    parser.add_argument("--top_k", help="number of top ops to list", type=int, default=20)
+
+def read_timelines(profile_dir):
+    timeline_paths = sorted(glob.glob(os.path.join(profile_dir, "timeline-*.json")))
+    if not timeline_paths:
+        raise ValueError("no timeline-*.json files found in {0}".format(profile_dir))
+    
+    for timeline_path in timeline_paths:
+        with open(timeline_path, "r") as file:
+            yield json.load(file)
+
+def get_op_pass(op_name):
+    """Gets whether an op belongs to the forward pass, the backward pass or the optimizer update."""
+    if re.search(r"(^|/)gradients(_\d+)?/", op_name):
+        return "backward"
+    
+    if re.search(r"adam|clip_by_global_norm|gradient_accumulation|global_norm", op_name, flags=re.IGNORECASE):
+        return "optimizer"
+    
+    return "forward"
+
+def get_op_component(op_name,
+                     op_type):
+    """Gets the part of the model an op belongs to. Dense layers are split into their matmuls and the rest, so that
+    e.g. the GELU of the intermediate layer shows up on its own."""
+    op_name = re.sub(r"^(.*/)?gradients(_\d+)?/", "", op_name)
+    for scope, component in COMPONENT_SCOPES:
+        if scope in op_name:
+            if component == "intermediate":
+                return "intermediate dense" if op_type in MATMUL_OPS else "intermediate GELU"
+            
+            if component == "attention":
+                return "attention matmul" if op_type in MATMUL_OPS else "attention softmax/mask"
+            
+            return component
+    
+    if any([op_name.startswith(scope) for scope in HEAD_SCOPES]) or re.match(r"^\w+/(token|sent)(_loss)?/", op_name):
+        return "task heads and loss"
+    
+    return "other"
+
+def get_op_key(op_name):
+    """Gets the op name with the gradients prefix and layer indices removed, so the same op of every layer adds up."""
+    op_name = re.sub(r"^(.*/)?gradients(_\d+)?/", "", op_name)
+    return re.sub(r"layer_\d+", "layer_*", op_name)
+
+def summarize_timelines(timelines):
+    """Adds up the op times of the traced steps by pass and component, and by op."""
+    num_steps = 0
+    component_times = collections.defaultdict(float)
+    op_times = collections.defaultdict(float)
+    op_types = {}
+    for timeline in timelines:
+        num_steps += 1
+        for event in timeline.get("traceEvents", []):
+            if event.get("ph") != "X" or "dur" not in event:
+                continue
+            
+            args = event.get("args", {})
+            op_name = args.get("name", event.get("name", ""))
+            op_type = args.get("op", event.get("name", ""))
+            if op_type in ["_SOURCE", "unknown"] or not op_name:
+                continue
+            
+            op_pass = get_op_pass(op_name)
+            component_times[(op_pass, get_op_component(op_name, op_type))] += event["dur"]
+            op_key = (op_pass, get_op_key(op_name))
+            op_times[op_key] += event["dur"]
+            op_types[op_key] = op_type
+    
+    return num_steps, component_times, op_times, op_types
+
+def profile_summary(profile_dir,
+                    top_k):
+    num_steps, component_times, op_times, op_types = summarize_timelines(read_timelines(profile_dir))
+    total_time = max(sum(component_times.values()), 1e-6)
+    
+    # Op times add up across threads, so they measure CPU time rather than wall time.
+    print("Traced steps: {0}, op time per step {1:.1f} ms".format(num_steps, total_time / num_steps / 1000.0))
+    print("")
+    print("{0:<10} {1:<24} {2:>12} {3:>8}".format("pass", "component", "ms/step", "share"))
+    for (op_pass, component), time in sorted(component_times.items(), key=lambda item: -item[1]):
+        print("{0:<10} {1:<24} {2:>12.2f} {3:>7.1%}".format(op_pass, component, time / num_steps / 1000.0, time / total_time))
+    
+    print("")
+    print("Top {0} ops (all layers together):".format(top_k))
+    print("{0:<10} {1:<16} {2:>12} {3:>8}  {4}".format("pass", "type", "ms/step", "share", "name"))
+    for (op_pass, op_key), time in sorted(op_times.items(), key=lambda item: -item[1])[:top_k]:
+        print("{0:<10} {1:<16} {2:>12.2f} {3:>7.1%}  {4}".format(op_pass, op_types[(op_pass, op_key)],
+            time / num_steps / 1000.0, time / total_time, op_key))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    profile_summary(args.profile_dir, args.top_k)
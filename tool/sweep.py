@@ -0,0 +1,210 @@
+import argparse
+import itertools
+import json
+import os
+import os.path
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def add_arguments(parser):
+    parser.add_argument("--task_type", help="task type, one of ner, nlu and classifier", required=True)
+    parser.add_argument("--task_name", help="task name", required=True)
+    parser.add_argument("--data_dir", help="input data directory", required=True)
+    parser.add_argument("--data_format", help="data format, json or jsonl", default="json")
+    parser.add_argument("--vocab_file", help="path to vocab file", required=True)
+    parser.add_argument("--do_lower_case", help="whether to lower case the input text", default="true")
+    parser.add_argument("--max_seq_length", help="maximum sequence length", type=int, default=128)
+    parser.add_argument("--doc_stride", help="ner only, stride of the sliding windows long sentences are split into, 0 to truncate them", type=int, default=0)
+    parser.add_argument("--output_dir", help="sweep output directory, holding the shared features and one sub-directory per run", required=True)
+    parser.add_argument("--seeds", help="comma-separated random seeds", default="100,200,300,400,500")
+    parser.add_argument("--learning_rates", help="comma-separated learning rates", default="5e-5")
+    parser.add_argument("--train_epochs", help="comma-separated numbers of train epochs", default="3.0")
+    parser.add_argument("--max_concurrency", help="number of runs at the same time", type=int, default=1)
+    parser.add_argument("--threads_per_run", help="number of CPU cores each run is pinned to, 0 to share all cores", type=int, default=0)
+    parser.add_argument("--gpu_devices", help="comma-separated GPU devices handed out to concurrent runs, empty to run on CPU", default="")
+    parser.add_argument("--num_preprocess_workers", help="number of worker processes for the shared preprocessing", type=int, default=1)
+
+def get_run_name(learning_rate,
+                 train_epochs,
+                 seed):
+    return "lr-{0}_epochs-{1}_seed-{2}".format(learning_rate, train_epochs, seed)
+
+def get_slot_cpus(slot_index,
+                  threads_per_run):
+    """Gets the CPU cores of a concurrency slot, so that concurrent runs do not fight over the same cores."""
+    if threads_per_run <= 0 or not hasattr(os, "sched_getaffinity"):
+        return None
+    
+    cpus = sorted(os.sched_getaffinity(0))
+    start = (slot_index * threads_per_run) % len(cpus)
+    return [cpus[(start + i) % len(cpus)] for i in range(min(threads_per_run, len(cpus)))]
+
+def build_features(args):
+    """Converts the data sets once into memory-mapped features, which every run then reads in place."""
+    feature_dir = os.path.join(args.output_dir, "features")
+    command = [sys.executable, os.path.join(ROOT_DIR, "tool", "build_memmap.py"),
+        "--task_type={0}".format(args.task_type),
+        "--task_name={0}".format(args.task_name),
+        "--data_dir={0}".format(args.data_dir),
+        "--data_format={0}".format(args.data_format),
+        "--vocab_file={0}".format(args.vocab_file),
+        "--do_lower_case={0}".format(args.do_lower_case),
+        "--max_seq_length={0}".format(args.max_seq_length),
+        "--doc_stride={0}".format(args.doc_stride),
+        "--num_workers={0}".format(args.num_preprocess_workers),
+        "--output_dir={0}".format(feature_dir)]
+    
+    subprocess.check_call(command, cwd=ROOT_DIR)
+    return feature_dir
+
+def start_run(args,
+              run_args,
+              feature_dir,
+              learning_rate,
+              train_epochs,
+              seed,
+              slot_index):
+    run_dir = os.path.join(args.output_dir, get_run_name(learning_rate, train_epochs, seed))
+    if not os.path.exists(run_dir):
+        os.makedirs(run_dir)
+    
+    command = [sys.executable, os.path.join(ROOT_DIR, "run_{0}.py".format(args.task_type))] + run_args + [
+        "--task_name={0}".format(args.task_name),
+        "--data_dir={0}".format(args.data_dir),
+        "--data_format={0}".format(args.data_format),
+        "--vocab_file={0}".format(args.vocab_file),
+        "--do_lower_case={0}".format(args.do_lower_case),
+        "--max_seq_length={0}".format(args.max_seq_length),
+        "--memmap_feature_dir={0}".format(feature_dir),
+        "--output_dir={0}".format(run_dir),
+        "--export_dir={0}".format(os.path.join(run_dir, "export")),
+        "--random_seed={0}".format(seed),
+        "--learning_rate={0}".format(learning_rate),
+        "--num_train_epochs={0}".format(train_epochs),
+        "--do_train=true",
+        "--do_eval=true"]
+    
+    if args.task_type == "ner":
+        command.append("--doc_stride={0}".format(args.doc_stride))
+    
+    env = dict(os.environ)
+    gpu_devices = [device for device in args.gpu_devices.split(",") if device.strip()]
+    env["CUDA_VISIBLE_DEVICES"] = gpu_devices[slot_index % len(gpu_devices)] if gpu_devices else ""
+    
+    # TensorFlow sizes its thread pools by the cores a process may run on, so pinning also caps its threads.
+    cpus = get_slot_cpus(slot_index, args.threads_per_run)
+    preexec_fn = None
+    if cpus is not None:
+        env["OMP_NUM_THREADS"] = str(len(cpus))
+        preexec_fn = lambda: os.sched_setaffinity(0, cpus)
+    
+    log_file = open(os.path.join(run_dir, "run.log"), "w")
+    print("Starting {0} on slot {1}".format(os.path.basename(run_dir), slot_index))
+    process = subprocess.Popen(command, cwd=ROOT_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT, preexec_fn=preexec_fn)
+    return process, log_file
+
+def run_grid(args,
+             run_args,
+             feature_dir,
+             grid):
+    """Runs the grid with at most `max_concurrency` runs at the same time, each one in its own slot of cores/GPUs.
+    Runs that already wrote their eval result are skipped, so an interrupted sweep can be resumed."""
+    pending = [(learning_rate, train_epochs, seed) for (learning_rate, train_epochs, seed) in grid
+        if not os.path.exists(os.path.join(args.output_dir, get_run_name(learning_rate, train_epochs, seed), "eval_result.json"))]
+    free_slots = list(range(max(args.max_concurrency, 1)))
+    running = []
+    failed = []
+    while pending or running:
+        while pending and free_slots:
+            (learning_rate, train_epochs, seed) = pending.pop(0)
+            slot_index = free_slots.pop(0)
+            process, log_file = start_run(args, run_args, feature_dir, learning_rate, train_epochs, seed, slot_index)
+            running.append((process, log_file, slot_index, get_run_name(learning_rate, train_epochs, seed)))
+        
+        time.sleep(1)
+        for item in list(running):
+            (process, log_file, slot_index, run_name) = item
+            if process.poll() is None:
+                continue
+            
+            log_file.close()
+            running.remove(item)
+            free_slots.append(slot_index)
+            if process.returncode != 0:
+                failed.append(run_name)
+                print("Run {0} failed with exit code {1}".format(run_name, process.returncode))
+            else:
+                print("Run {0} is done".format(run_name))
+    
+    return failed
+
+def aggregate_results(args,
+                      grid):
+    """Aggregates the eval results of every setting over its seeds into mean and standard deviation."""
+    results = []
+    for (learning_rate, train_epochs), settings in itertools.groupby(grid, key=lambda setting: setting[:2]):
+        metric_values = {}
+        num_runs = 0
+        for (_, _, seed) in settings:
+            result_path = os.path.join(args.output_dir, get_run_name(learning_rate, train_epochs, seed), "eval_result.json")
+            if not os.path.exists(result_path):
+                continue
+            
+            with open(result_path, "r") as file:
+                eval_result = json.load(file)
+            
+            num_runs += 1
+            for name, value in eval_result.items():
+                if name not in ["global_step", "loss"]:
+                    metric_values.setdefault(name, []).append(value)
+        
+        result = {
+            "learning_rate": learning_rate,
+            "train_epochs": train_epochs,
+            "num_runs": num_runs,
+            "metrics": dict([(name, { "mean": float(np.mean(values)), "std": float(np.std(values, ddof=1)) if len(values) > 1 else 0.0 })
+                for (name, values) in metric_values.items()])
+        }
+        
+        results.append(result)
+    
+    return results
+
+def print_results(results):
+    metric_names = sorted(set([name for result in results for name in result["metrics"].keys()]))
+    print("{0:>14} {1:>8} {2:>6} ".format("learning_rate", "epochs", "runs") + " ".join(["{0:>20}".format(name) for name in metric_names]))
+    for result in results:
+        metrics = result["metrics"]
+        print("{0:>14} {1:>8} {2:>6} ".format(result["learning_rate"], result["train_epochs"], result["num_runs"]) +
+            " ".join(["{0:>20}".format("{0:.4f} ± {1:.4f}".format(metrics[name]["mean"], metrics[name]["std"]) if name in metrics else "-")
+                for name in metric_names]))
+
+def sweep(args,
+          run_args):
+    grid = list(itertools.product(
+        [value.strip() for value in args.learning_rates.split(",") if value.strip()],
+        [value.strip() for value in args.train_epochs.split(",") if value.strip()],
+        [value.strip() for value in args.seeds.split(",") if value.strip()]))
+    
+    feature_dir = build_features(args)
+    failed = run_grid(args, run_args, feature_dir, grid)
+    
+    results = aggregate_results(args, grid)
+    with open(os.path.join(args.output_dir, "sweep_result.json"), "w") as file:
+        json.dump(results, file, indent=4)
+    
+    print_results(results)
+    if failed:
+        print("Failed runs (see run.log in their directories): {0}".format(", ".join(failed)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a grid of seeds, learning rates and epochs of run_<task_type>.py, "
+        "sharing one preprocessing. Unknown arguments, e.g. --bert_config_file, are passed on to every run.")
+    add_arguments(parser)
+    args, run_args = parser.parse_known_args()
+    sweep(args, run_args)